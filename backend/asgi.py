@@ -0,0 +1,146 @@
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flaskapp import create_app
+
+'''
+ASGI entry point
+
+    uvicorn asgi:app --workers 4
+
+Serves the Flask application, its routes, authorization and response envelopes unchanged, from
+an ASGI server. The application is not asynchronous: psycopg2 and SQLAlchemy 1.3 block, so it
+runs on a pool of ASGI_THREADS threads and a worker serves at most ASGI_THREADS requests at a
+time, as a threaded WSGI server does. Only the request bodies are read on the event loop: a slow
+upload holds no thread, a body above ASGI_MAX_BODY_SIZE bytes is rejected with 413, and a request
+whose client disconnects before the end of its body is dropped, without running the application
+on a partial payload. A response holds its thread from its first to its last chunk, until the
+client has taken it, as the flask and SQLAlchemy contexts are thread-local: slow downloads and
+long exports take a thread each.
+'''
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+ASGI_MAX_BODY_SIZE = int(os.environ.get('ASGI_MAX_BODY_SIZE', 16 * 1024 * 1024))
+
+# read_body result of a client gone before the end of its request body
+DISCONNECTED = object()
+
+class ASGIBridge(object):
+    """ASGI application running a WSGI application on a thread pool
+    Keyword arguments:
+        wsgi_app -- the WSGI application
+        threads -- the number of threads running the WSGI application
+        max_body_size -- the largest request body accepted, in bytes
+    """
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, max_body_size=ASGI_MAX_BODY_SIZE):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"unsupported ASGI scope {scope['type']}")
+        body = await self.read_body(receive)
+        if body is DISCONNECTED:
+            return
+        if body is None:
+            await self.send_error(send, 413, 'Payload Too Large', f'the request body exceeds {self.max_body_size} bytes')
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.run, self.environ(scope, body), loop, send)
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    async def read_body(self, receive):
+        """Read the whole request body on the event loop, None when it is too large, DISCONNECTED
+        when the client is gone before its end
+        """
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return DISCONNECTED
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+    async def send_error(self, send, status, title, detail):
+        """Send the error envelope of responses.Response.error_response without the application"""
+        body = json.dumps({'success': False, 'status': status, 'type': 'about:blank', 'title': title, 'detail': detail, 'instance': 'about:blank'}).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
+    @staticmethod
+    def environ(scope, body):
+        """Build the WSGI environ of an ASGI http scope"""
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+    def run(self, environ, loop, send):
+        """Run the WSGI application on a thread of the pool, the messages are sent on the event
+        loop, one at a time: the thread waits for each chunk to be sent, which keeps a slow client
+        from buffering the whole response, and holds the thread until the client has taken it
+        """
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        response = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response and response[0] is None:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [int(status.split(' ', 1)[0]), [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+        def send_start():
+            status, headers = response
+            send_message({'type': 'http.response.start', 'status': status, 'headers': headers})
+            # the headers are sent, start_response can no longer replace them
+            response[0] = None
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if response[0] is not None:
+                    send_start()
+                if chunk:
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if response[0] is not None:
+                send_start()
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+app = ASGIBridge(create_app())
@@ -1,13 +1,188 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
+from jose.utils import base64url_decode
 from urllib.request import urlopen
 from responses import AppError
+import metrics
 
-AUTH0_DOMAIN = 'fsnder.eu.auth0.com'
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'fsnder.eu.auth0.com')
 ALGORITHMS = ['RS256']
-API_AUDIENCE = 'castingagencyapi'
+API_AUDIENCE = os.environ.get('API_AUDIENCE', 'castingagencyapi')
+
+'''
+JWKS Configuration
+
+'''
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
+logger = logging.getLogger(__name__)
+
+class KeyStore(object):
+    """Process-wide store of the JWKS signing keys, parsed once and indexed by kid.
+    The keys are refreshed in the background once older than the ttl, re-fetched on demand
+    only for an unknown kid (at most once per min_refresh_interval), and the last good keys
+    keep being served while the JWKS endpoint is unreachable.
+    Keyword arguments:
+        url -- the url of the JWKS document (https://, http:// or file://)
+        ttl -- the seconds after which the keys are refreshed in the background
+        min_refresh_interval -- the minimum seconds between two forced refreshes
+        timeout -- the seconds to wait for the JWKS endpoint
+    """
+    def __init__(self, url, ttl=JWKS_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._forced_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+    def fetch(self):
+        """Download and parse the JWKS document, replacing the stored keys on success
+        """
+        self.fetch_count += 1
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key or key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+    def refresh(self):
+        """Fetch the JWKS document, keeping the last good keys if the endpoint fails
+        """
+        with self._fetch_lock:
+            try:
+                self.fetch()
+                return True
+            except Exception:
+                logger.exception('Unable to refresh the JWKS from %s', self.url)
+                return False
+            finally:
+                self._refreshing = False
+    def refresh_in_background(self):
+        """Start a refresh in a daemon thread unless one is already running
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name='jwks-refresh', daemon=True).start()
+    def force_refresh(self):
+        """Refresh synchronously, at most once per min_refresh_interval
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._forced_at is not None and now - self._forced_at < self.min_refresh_interval:
+                return False
+            self._forced_at = now
+        return self.refresh()
+    def get_key(self, kid):
+        """Get the parsed signing key for a kid, None if the JWKS does not publish it
+        Keyword arguments:
+            kid -- the key id from the token header
+        """
+        if self._fetched_at is None:
+            self.force_refresh()
+            if self._fetched_at is None:
+                raise AppError(status_code= 503, title= 'jwks_unavailable',detail= 'Unable to fetch the signing keys.')
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self.refresh_in_background()
+        key = self._keys.get(kid)
+        if key is None and self.force_refresh():
+            key = self._keys.get(kid)
+        return key
+
+key_store = KeyStore(JWKS_URL)
+
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'expires_at'])
+
+class TokenCache(object):
+    """Bounded LRU of already verified tokens, keyed by a hash of the raw token.
+    Each entry keeps the decoded payload and the set of permissions until the token exp.
+    Keyword arguments:
+        maxsize -- the maximum number of tokens kept, the least recently used is evicted
+    """
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+    def get(self, token):
+        """Get the VerifiedToken for a raw token, None if unknown or expired
+        Keyword arguments:
+            token -- the raw JWT
+        """
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    def set(self, token, payload):
+        """Store a verified payload until its exp, returns the VerifiedToken
+        Keyword arguments:
+            token -- the raw JWT
+            payload -- the payload returned by verify_decode_jwt
+        """
+        permissions = frozenset(payload['permissions']) if 'permissions' in payload else None
+        entry = VerifiedToken(payload, permissions, payload.get('exp', 0))
+        if self.maxsize <= 0 or entry.expires_at <= time.time():
+            return entry
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    def stats(self):
+        """Get the cache counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+token_cache = TokenCache()
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
@@ -25,31 +200,39 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
+def verify_signature(token, key):
+    """Check the token signature against an already parsed key
+    Keyword arguments:
+        token -- the raw JWT
+        key -- the jose key object from the key store
+    """
+    signing_input, _, encoded_signature = token.rpartition('.')
+    signature = base64url_decode(encoded_signature.encode('utf-8'))
+    return key.verify(signing_input.encode('utf-8'), signature)
+
 def verify_decode_jwt(token):
-    unverified_header = jwt.get_unverified_header(token)
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AppError(status_code= 400,title='invalid_header',detail='Unable to parse authentication token.')
     if 'kid' not in unverified_header:
         raise AppError(status_code= 401, title= 'invalid_header',detail= 'Authorization malformed.')
+    if unverified_header.get('alg') not in ALGORITHMS:
+        raise AppError(status_code= 401, title= 'invalid_header',detail= 'Signing algorithm not allowed.')
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())    
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = key_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
+            if not verify_signature(token, rsa_key):
+                raise jwt.JWTError('Signature verification failed.')
+            # the signature is checked above with the cached key, decode only validates the claims
             payload = jwt.decode(
                 token,
-                rsa_key,
+                '',
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
 
             return payload
@@ -62,10 +245,10 @@ def verify_decode_jwt(token):
             raise AppError(status_code= 400,title='invalid_header',detail='Unable to parse authentication token.')
     raise AppError(status_code= 400,title='invalid_header',detail='Unable to find the appropriate key.')
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
+def check_permissions(permission, permissions):
+    if permissions is None:
         raise AppError(status_code= 400,title='invalid_claims',detail='Permissions not included in JWT.')
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AppError(status_code= 401,title='unauthorized',detail='Permission not found.')
     return True
 
@@ -73,10 +256,27 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            started = time.perf_counter()
+            outcome = 'rejected'
+            try:
+                token = get_token_auth_header()
+                verified = token_cache.get(token)
+                outcome = 'cached'
+                if verified is None:
+                    outcome = 'rejected'
+                    verified = token_cache.set(token, verify_decode_jwt(token))
+                    outcome = 'verified'
+                check_permissions(permission, verified.permissions)
+            except AppError:
+                outcome = 'rejected'
+                raise
+            finally:
+                metrics.observe_auth(time.perf_counter() - started, outcome)
+            ctx = _request_ctx_stack.top
+            ctx.current_user = verified.payload
+            # the endpoints of the get: permissions only read, they can use a read replica
+            ctx.read_only = permission.startswith('get:')
             return f(*args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
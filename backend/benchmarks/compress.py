@@ -0,0 +1,58 @@
+"""Compare the CPU cost and the transfer time of the response compressions on GET /movies
+
+    python benchmarks/compress.py --movies 10000 --bandwidth 10
+
+Encodes a page of movies as JSON, then compresses it with every gzip level and Brotli quality
+available. For each, reports the compressed size, the compression time (best of the repeats),
+and the time to send the response at the bandwidth given in Mbit/s, CPU included.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+from responses import JSONSerializer
+from serializers import movie_payload
+
+
+def measure(encoder_class, level, body, repeat):
+    """Get (bytes, best seconds) of a compression"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encoder = encoder_class(level)
+        data = encoder.compress(body) + encoder.finish()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data), best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bandwidth', type=float, default=10, help='client bandwidth in Mbit/s')
+    args = parser.parse_args()
+    body = JSONSerializer().dumps(movie_payload(args.movies))
+    bytes_per_second = args.bandwidth * 1e6 / 8
+
+    runs = [('identity', None, None)]
+    runs += [('gzip', compression.GzipEncoder, level) for level in (1, 4, 6, 9)]
+    if compression.brotli is not None:
+        runs += [('br', compression.BrotliEncoder, quality) for quality in (1, 4, 6, 9, 11)]
+
+    print(f'{args.movies} movies, {len(body)} bytes of JSON, {args.bandwidth} Mbit/s')
+    print(f'{"coding":<10}{"level":>6}{"bytes":>12}{"ratio":>8}{"cpu ms":>10}{"MB/s":>8}{"total ms":>10}')
+    for name, encoder_class, level in runs:
+        if encoder_class is None:
+            size, elapsed = len(body), 0.0
+        else:
+            size, elapsed = measure(encoder_class, level, body, args.repeat)
+        total = elapsed + size / bytes_per_second
+        speed = f'{len(body) / elapsed / 1e6:>8.1f}' if elapsed else f'{"-":>8}'
+        print(f'{name:<10}{"-" if level is None else level:>6}{size:>12}{len(body) / size:>8.1f}{elapsed * 1000:>10.1f}{speed}{total * 1000:>10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Compare the requests/sec and latencies of the WSGI and ASGI entry points at high concurrency
+
+    python benchmarks/concurrency.py --concurrency 256 --requests 5000 --threads 8
+
+Starts the application with gunicorn (gthread worker, create_app) and with uvicorn (asgi:app),
+one worker process and the same number of threads each, then keeps --concurrency keep-alive
+connections busy with GET requests signed by a local key. Reports the throughput, the p50 and
+p99 latencies and the failures of each server. DATABASE_PATH must point to a seeded database.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt, jwk
+import authorization
+
+
+def signing_setup(directory, permissions):
+    """Write a JWKS file of a new local key, returns (jwks url, signed token)"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': 'bench-key', 'use': 'sig'})
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as jwks_file:
+        json.dump({'keys': [public_jwk]}, jwks_file)
+    claims = {
+        'iss': 'https://' + authorization.AUTH0_DOMAIN + '/',
+        'aud': authorization.API_AUDIENCE,
+        'sub': 'bench|client',
+        'iat': int(time.time()),
+        'exp': int(time.time()) + 3600,
+        'permissions': permissions
+    }
+    return 'file://' + path, jwt.encode(claims, pem, algorithm='RS256', headers={'kid': 'bench-key'})
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(kind, port, threads, env):
+    if kind == 'wsgi':
+        command = ['gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads), '--backlog', '2048', '-b', f'127.0.0.1:{port}', 'flaskapp:create_app()']
+    else:
+        command = ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port), '--workers', '1', '--backlog', '2048', '--log-level', 'warning', '--no-access-log']
+        env = dict(env, ASGI_THREADS=str(threads))
+    bindir = os.path.dirname(sys.executable)
+    command[0] = os.path.join(bindir, command[0]) if os.path.exists(os.path.join(bindir, command[0])) else command[0]
+    return subprocess.Popen(command, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+                sock.sendall(b'GET /health HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+                if sock.recv(16).startswith(b'HTTP/1.1 200'):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'the server on port {port} did not start')
+
+async def read_response(reader):
+    """Read an HTTP/1.1 response, returns the status and the body"""
+    status = int((await reader.readline()).split()[1])
+    length, chunked = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+    chunks = []
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            chunks.append((await reader.readexactly(size + 2))[:size])
+            if size == 0:
+                break
+    else:
+        chunks.append(await reader.readexactly(length))
+    return status, b''.join(chunks)
+
+async def client(port, request, counter, total, latencies, failures):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while next(counter) < total:
+            started = time.perf_counter()
+            writer.write(request)
+            try:
+                status, _ = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                failures.append('connection')
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                continue
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                failures.append(status)
+    finally:
+        writer.close()
+
+async def load(port, path, token, concurrency, total):
+    request = f'GET {path} HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer {token}\r\nAccept-Encoding: identity\r\n\r\n'.encode('latin-1')
+    counter = itertools.count()
+    latencies, failures = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*[client(port, request, counter, total, latencies, failures) for _ in range(concurrency)])
+    return time.perf_counter() - started, sorted(latencies), failures
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8, help='threads of the gthread worker and ASGI_THREADS')
+    parser.add_argument('--path', default='/movies?page=1')
+    parser.add_argument('--server', choices=['wsgi', 'asgi', 'both'], default='both')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        jwks_url, token = signing_setup(directory, ['get:movies', 'get:actors'])
+        env = dict(os.environ, JWKS_URL=jwks_url)
+        print(f'GET {args.path}, {args.requests} requests, {args.concurrency} connections, {args.threads} threads')
+        print(f'{"server":<8}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"failed":>8}')
+        for kind in (['wsgi', 'asgi'] if args.server == 'both' else [args.server]):
+            port = free_port()
+            server = start_server(kind, port, args.threads, env)
+            try:
+                wait_ready(port)
+                # warm up the connections, the token cache and the read cache
+                asyncio.run(load(port, args.path, token, min(args.concurrency, 8), 100))
+                elapsed, latencies, failures = asyncio.run(load(port, args.path, token, args.concurrency, args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+            print(f'{kind:<8}{len(latencies) / elapsed:>10.0f}{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}{len(failures):>8}')
+
+if __name__ == '__main__':
+    main()
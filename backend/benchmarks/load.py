@@ -0,0 +1,316 @@
+"""Load test the API end to end with a mixed read and write workload
+
+    python benchmarks/load.py --seed --movies 20000 --actors 50000 --duration 60 --concurrency 64
+    python benchmarks/load.py --compare load-1a2b3c4.json load-5d6e7f8.json
+
+Starts the application (create_app with gunicorn, or asgi:app with uvicorn) against the Postgres
+of DATABASE_PATH, with tokens signed by a local key published through a JWKS file. With --seed
+the schema is migrated and the tables are filled with the catalog of manage.py seed: --movies
+movies with --roles roles on average, every role cast with one of --actors actors. The clients
+then keep --concurrency keep-alive connections busy for --duration seconds with requests drawn
+from the weighted operations of --mix, over every endpoint: lists, searches, casts, exports, the
+movies, costars and paths of the actors, and the create, read, update and delete of movies,
+actors and roles. The writes only update and delete what the clients created, and what they
+created is removed after the run, so the catalog stays the same from one run to the next.
+
+Prints the requests/sec, the p50, p95 and p99 latencies and the errors per operation, and writes
+them with the revision and the parameters as JSON to --output (load-<revision>.json by default).
+--compare prints the change of two result files, per operation.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, BACKEND)
+
+from concurrency import signing_setup, free_port, start_server, wait_ready, read_response, percentile
+from seeder import Catalog, seed_catalog, GENRES, GENDERS, ROLE_TYPES
+
+PERMISSIONS = ['get:movies', 'get:actors', 'post:movies', 'post:actors', 'post:roles', 'patch:movies',
+    'patch:actors', 'patch:roles', 'delete:movies', 'delete:actors']
+
+def seed_database(catalog):
+    """Migrate the schema of DATABASE_PATH and replace its rows with the generated catalog"""
+    from flask_migrate import upgrade
+    from flaskapp import create_app
+    from models import db
+    app = create_app()
+    with app.app_context():
+        upgrade(directory=os.path.join(BACKEND, 'migrations'))
+        seed_catalog(catalog.movies, catalog.actors, catalog.mean_roles, catalog.seed, truncate=True, out=lambda line: None)
+        db.engine.dispose()
+
+'''
+Workload
+'''
+class Client(object):
+    """A client of the load test: its random generator, the catalog it reads and the movies,
+    actors and roles it created
+    """
+    def __init__(self, rng, catalog):
+        self.rng = rng
+        self.catalog = catalog
+        self.movies = catalog.movies
+        self.actors = catalog.actors
+        # the movies without roles, which can be deleted, the cast movies, the actors and the roles
+        self.created = {'movies': [], 'cast': [], 'actors': [], 'roles': []}
+        # every id the client created, removed from the database after the run
+        self.history = {'movies': [], 'actors': [], 'roles': []}
+    def movie_id(self):
+        return self.rng.randint(1, self.movies)
+    def actor_id(self):
+        return self.rng.randint(1, self.actors)
+    def word(self):
+        # the search terms are as frequent as in the titles
+        return self.rng.choices(self.catalog.words, cum_weights=self.catalog.word_weights)[0]
+    def last_name(self):
+        return self.rng.choices(self.catalog.last_names, cum_weights=self.catalog.last_weights)[0]
+    def title(self):
+        return ' '.join(self.word() for _ in range(self.rng.randint(1, 4)))
+    def person(self):
+        return self.rng.choice(self.catalog.first_names) + ' ' + self.last_name()
+    def page(self, count, per_page=10):
+        # the first pages are the most read
+        return min(int(self.rng.paretovariate(1.2)), max(1, count // per_page))
+
+def new_movie(client):
+    return {'name': client.title(), 'timestamp': client.rng.randint(0, 1600000000), 'genres': client.rng.sample(GENRES, 2)}
+
+def new_actor(client):
+    return {'name': client.person(), 'gender': client.rng.choice(GENDERS), 'age': client.rng.randint(8, 90)}
+
+def export_range(client, count=100):
+    first = client.rng.randint(0, max(0, client.movies - count))
+    return first, first + count
+
+def created(client, *kinds):
+    """The id of one of the objects of the kinds the client created"""
+    return client.rng.choice([object_id for kind in kinds for object_id in client.created[kind]])
+
+# name -> (weight of the read and write mixes, request builder returning (method, path, body), expected statuses)
+OPERATIONS = {
+    'list_movies': ((20, 10), lambda c: ('GET', f'/movies?page={c.page(c.movies)}', None), 200),
+    'list_movies_cursor': ((5, 3), lambda c: ('GET', '/movies?cursor=&sort=name', None), 200),
+    'list_actors': ((15, 8), lambda c: ('GET', f'/actors?page={c.page(c.actors)}', None), 200),
+    'read_movie': ((20, 12), lambda c: ('GET', f'/movies/{c.movie_id()}', None), 200),
+    'read_actor': ((15, 8), lambda c: ('GET', f'/actors/{c.actor_id()}', None), 200),
+    'movie_actors': ((10, 6), lambda c: ('GET', f'/movies/{c.movie_id()}/actors', None), 200),
+    'actor_movies': ((3, 2), lambda c: ('GET', f'/actors/{c.actor_id()}/movies?page=1', None), 200),
+    'actor_costars': ((2, 1), lambda c: ('GET', f'/actors/{c.actor_id()}/costars?page=1', None), 200),
+    'actors_path': ((2, 1), lambda c: ('GET', f'/actors/{c.actor_id()}/path/{c.actor_id()}', None), (200, 404)),
+    'search_movies': ((8, 5), lambda c: ('POST', '/movies/search', {'searchTerm': c.word()}), 200),
+    'search_actors': ((6, 4), lambda c: ('POST', '/actors/search', {'searchName': c.last_name(), 'searchAgeMin': 20}), 200),
+    'export_movies': ((1, 1), lambda c: ('GET', '/movies/export?after_id={0}&until_id={1}'.format(*export_range(c)), None), 200),
+    'create_movie': ((0, 8), lambda c: ('POST', '/movies', new_movie(c)), 201),
+    'create_actor': ((0, 8), lambda c: ('POST', '/actors', new_actor(c)), 201),
+    'update_movie': ((0, 5), lambda c: ('PATCH', f"/movies/{created(c, 'movies', 'cast')}", {'name': c.title()}), 200),
+    'update_actor': ((0, 5), lambda c: ('PATCH', f"/actors/{created(c, 'actors')}", {'age': c.rng.randint(8, 90)}), 200),
+    'create_role': ((0, 5), lambda c: ('POST', '/roles', {'name': c.rng.choice(c.catalog.first_names), 'type': c.rng.choice(ROLE_TYPES), 'movie': created(c, 'movies')}), 201),
+    'cast_role': ((0, 5), lambda c: ('PATCH', f"/roles/{created(c, 'roles')}", {'actor': c.actor_id()}), 200),
+    'delete_movie': ((0, 3), lambda c: ('DELETE', f"/movies/{c.created['movies'].pop()}", None), 200),
+    'delete_actor': ((0, 3), lambda c: ('DELETE', f"/actors/{c.created['actors'].pop()}", None), 200),
+}
+MIXES = {'read': 0, 'mixed': 1}
+# the operations needing an object the client created, and the operation creating it
+REQUIRES = {'update_movie': 'movies', 'update_actor': 'actors', 'create_role': 'movies', 'cast_role': 'roles',
+    'delete_movie': 'movies', 'delete_actor': 'actors'}
+CREATES = {'movies': 'create_movie', 'actors': 'create_actor', 'roles': 'create_role'}
+
+def choose_operation(client, names, weights):
+    name = client.rng.choices(names, weights)[0]
+    # without an object of its own to update, the client creates one first
+    while name in REQUIRES and not client.created[REQUIRES[name]]:
+        name = CREATES[REQUIRES[name]]
+    return name
+
+def expected_statuses(name):
+    expected = OPERATIONS[name][2]
+    return expected if isinstance(expected, tuple) else (expected,)
+
+def http_request(method, path, token, body):
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    head = f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer {token}\r\nAccept-Encoding: identity\r\n'
+    if body is not None:
+        head += 'Content-Type: application/json\r\n'
+    head += f'Content-Length: {len(payload)}\r\n\r\n'
+    return head.encode('latin-1') + payload
+
+def remember(client, name, body):
+    """Keep the id of the object a create operation returned"""
+    kind = {'create_movie': 'movies', 'create_actor': 'actors', 'create_role': 'roles'}.get(name)
+    if kind is None:
+        return
+    data = json.loads(body)['data']
+    client.created[kind].append(data['id'])
+    client.history[kind].append(data['id'])
+    if kind == 'roles' and data['role']['movie'] in client.created['movies']:
+        # a movie with roles can no longer be deleted through the API
+        client.created['movies'].remove(data['role']['movie'])
+        client.created['cast'].append(data['role']['movie'])
+
+async def run_client(port, token, client, names, weights, deadline, results):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            name = choose_operation(client, names, weights)
+            method, path, body = OPERATIONS[name][1](client)
+            started = time.perf_counter()
+            writer.write(http_request(method, path, token, body))
+            try:
+                status, response_body = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                results[name]['errors'].append('connection')
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                continue
+            results[name]['latencies'].append(time.perf_counter() - started)
+            if status not in expected_statuses(name):
+                results[name]['errors'].append(status)
+            else:
+                remember(client, name, response_body)
+    finally:
+        writer.close()
+
+async def run_load(port, token, args, catalog, duration, seed):
+    index = MIXES[args.mix]
+    names = [name for name, (weights, _, _) in OPERATIONS.items() if weights[index] > 0]
+    weights = [OPERATIONS[name][0][index] for name in names]
+    results = {name: {'latencies': [], 'errors': []} for name in names}
+    results.update({name: {'latencies': [], 'errors': []} for name in CREATES.values()})
+    clients = [Client(random.Random(seed * 1000003 + number), catalog) for number in range(args.concurrency)]
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*[run_client(port, token, client, names, weights, deadline, results) for client in clients])
+    elapsed = time.perf_counter() - started
+    remove_created({kind: [object_id for client in clients for object_id in client.history[kind]] for kind in ('movies', 'actors', 'roles')})
+    return elapsed, {name: result for name, result in results.items() if result['latencies'] or result['errors']}
+
+def remove_created(ids):
+    """Delete the movies, actors and roles the clients created, the API has no delete for the roles
+    Keyword arguments:
+        ids -- the dict of the lists of ids of the movies, actors and roles
+    """
+    from sqlalchemy import create_engine, text
+    engine = create_engine(os.environ['DATABASE_PATH'])
+    try:
+        with engine.begin() as connection:
+            for statement in ('DELETE FROM actors_for_roles WHERE role_id = ANY(:roles) OR actor_id = ANY(:actors)',
+                    'DELETE FROM roles_in_movies WHERE role_id = ANY(:roles) OR movie_id = ANY(:movies)',
+                    'DELETE FROM "Roles" WHERE id = ANY(:roles)',
+                    'DELETE FROM "Movies" WHERE id = ANY(:movies)',
+                    'DELETE FROM "Actors" WHERE id = ANY(:actors)'):
+                connection.execute(text(statement), ids)
+    finally:
+        engine.dispose()
+
+'''
+Results
+'''
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_statuses': sorted(set(str(error) for error in errors)),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_table(operations):
+    print(f'{"operation":<20}{"requests":>10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for name, stats in operations.items():
+        print(f'{name:<20}{stats["requests"]:>10}{stats["requests_per_second"]:>10.1f}{stats["p50_ms"]:>10.1f}{stats["p95_ms"]:>10.1f}{stats["p99_ms"]:>10.1f}{stats["errors"]:>8}')
+
+def compare(before_path, after_path):
+    """Print the change of the throughput and latencies of two result files, per operation"""
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f'{before["revision"]} -> {after["revision"]}')
+    print(f'{"operation":<20}{"req/s":>10}{"p50":>10}{"p95":>10}{"p99":>10}')
+    rows = dict(after['operations'], total=after['total'])
+    for name, stats in rows.items():
+        old = before['total'] if name == 'total' else before['operations'].get(name)
+        if old is None:
+            continue
+        changes = [f'{(stats[key] - old[key]) / old[key] * 100:+.1f}%' if old[key] else 'n/a'
+            for key in ('requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms')]
+        print(f'{name:<20}' + ''.join(f'{change:>10}' for change in changes))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', action='store_true', help='empty the database of DATABASE_PATH and load a generated catalog')
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--actors', type=int, default=5000)
+    parser.add_argument('--roles', type=int, default=5, help='mean number of roles per movie')
+    parser.add_argument('--random-seed', dest='random_seed', type=int, default=1, help='the seed of the catalog and of the clients')
+    parser.add_argument('--mix', choices=list(MIXES), default='mixed')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before the measure')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the gthread worker and ASGI_THREADS')
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--output', default=None, help='the JSON results file, - for the standard output')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if 'DATABASE_PATH' not in os.environ:
+        parser.error('DATABASE_PATH must point to the Postgres database of the benchmark')
+    catalog = Catalog(args.random_seed, args.movies, args.actors, args.roles)
+    if args.seed:
+        started = time.monotonic()
+        seed_database(catalog)
+        print(f'seeded {args.movies} movies, {args.actors} actors, about {args.movies * args.roles} roles in {time.monotonic() - started:.1f}s', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        jwks_url, token = signing_setup(directory, PERMISSIONS)
+        port = free_port()
+        server = start_server(args.server, port, args.threads, dict(os.environ, JWKS_URL=jwks_url))
+        try:
+            wait_ready(port)
+            if args.warmup > 0:
+                asyncio.run(run_load(port, token, args, catalog, args.warmup, args.random_seed + 1))
+            elapsed, results = asyncio.run(run_load(port, token, args, catalog, args.duration, args.random_seed))
+        finally:
+            server.terminate()
+            server.wait()
+
+    operations = {name: summarize(result['latencies'], result['errors'], elapsed) for name, result in sorted(results.items())}
+    report = {
+        'revision': revision(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'parameters': {key: getattr(args, key) for key in ('movies', 'actors', 'roles', 'random_seed', 'mix', 'concurrency', 'duration', 'threads', 'server')},
+        'total': summarize([latency for result in results.values() for latency in result['latencies']],
+            [error for result in results.values() for error in result['errors']], elapsed),
+        'operations': operations,
+    }
+    print_table(dict(operations, total=report['total']))
+    output = args.output or f'load-{report["revision"]}.json'
+    if output == '-':
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(output, 'w') as out:
+            json.dump(report, out, indent=2)
+        print(f'results written to {output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
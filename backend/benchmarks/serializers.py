@@ -0,0 +1,80 @@
+"""Compare the response serializers on a list of movies shaped like GET /movies
+
+    python benchmarks/serializers.py --movies 10000 --repeat 5
+
+Reports, for every serializer available, the size of the encoded payload and the encoding
+throughput in bytes per second (best of the repeats).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, json as flask_json
+import responses
+
+
+def movie_payload(count, roles=3, actors=2):
+    """Build the responseStruct of a page of formatted movies, with their roles and actors"""
+    movies = []
+    for index in range(count):
+        movies.append({
+            'name': f'The Movie {index}',
+            'photoUrl': f'https://images.example.com/movies/{index}.png',
+            'release': (datetime(1990, 1, 1) + timedelta(days=index)).isoformat(),
+            'genres': ['Drama', 'Comedy', 'Thriller'][:1 + index % 3],
+            'roles': [{
+                'name': f'Role {index}-{role}',
+                'types': 'Lead Actor' if role == 0 else 'extra',
+                'movie': index,
+                'actors': [{
+                    'name': f'Actor {index * actors + actor}',
+                    'photoUrl': '',
+                    'gender': 'Female' if actor % 2 else 'Male',
+                    'age': 20 + (index + actor) % 50
+                } for actor in range(actors)]
+            } for role in range(roles)]
+        })
+    return {'success': True, 'data': {'movies': movies, 'total': count, 'count': count}}
+
+def measure(encode, payload, repeat):
+    """Get (bytes, best seconds) of an encoder"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(payload)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body), best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    payload = movie_payload(args.movies)
+
+    app = Flask(__name__)
+    encoders = []
+    # what Response.success_response did before: Flask jsonify, sorted keys with the stdlib encoder
+    encoders.append(('flask jsonify', lambda value: flask_json.dumps(value, separators=(',', ':')).encode('utf-8')))
+    # the fallback of JSONSerializer when orjson is not installed
+    encoders.append(('stdlib json', lambda value: json.dumps(value, default=responses.to_serializable, separators=(',', ':'), ensure_ascii=False).encode('utf-8')))
+    if responses.orjson is not None:
+        encoders.append(('orjson', responses.JSONSerializer().dumps))
+    if responses.msgpack is not None:
+        encoders.append(('msgpack', responses.MessagePackSerializer().dumps))
+
+    print(f'{args.movies} movies, best of {args.repeat}')
+    print(f'{"serializer":<16}{"bytes":>12}{"ms":>10}{"MB/s":>10}')
+    with app.app_context():
+        for name, encode in encoders:
+            size, elapsed = measure(encode, payload, args.repeat)
+            print(f'{name:<16}{size:>12}{elapsed * 1000:>10.1f}{size / elapsed / 1e6:>10.1f}')
+
+if __name__ == '__main__':
+    main()
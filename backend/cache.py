@@ -0,0 +1,378 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+'''
+Read cache
+
+The formatted results of the read paths are stored in a backend: a bounded LRU of the process
+(local://), a SQLite file in WAL mode shared by the workers of a host and kept across restarts
+(sqlite:///path), or a memcached server shared by every worker (memcached://host:port).
+Each entry is tagged with the resources it was built from: ('movie', id), ('actor', id), or
+'movies' and 'actors' for the lists. Every tag has a generation counter stored next to the
+entries; a write increments the counters of its tags once committed, and an entry is only
+served when it was stored under the current generations of all its tags. The generations are
+read together with the entries, before the database, so a result loaded while a write was
+committed is stored under the previous generation and never served.
+'''
+READ_CACHE_URL = os.environ.get('READ_CACHE_URL', 'local://')
+READ_CACHE_SIZE = int(os.environ.get('READ_CACHE_SIZE', 1024))
+READ_CACHE_TTL = float(os.environ.get('READ_CACHE_TTL', 60))
+READ_CACHE_TIMEOUT = float(os.environ.get('READ_CACHE_TIMEOUT', 0.5))
+READ_CACHE_PREFIX = os.environ.get('READ_CACHE_PREFIX', 'ca')
+
+logger = logging.getLogger(__name__)
+
+class CacheBackend(object):
+    """Storage of the read cache: JSON values with a TTL, and integer counters without TTL.
+    A backend may drop any key at any time, a failure of the storage is a miss.
+    """
+    name = None
+    def get_many(self, keys):
+        """Get the values found for a list of String keys, as a dict"""
+        raise NotImplementedError
+    def set_many(self, items, ttl):
+        """Store a dict of values for ttl seconds"""
+        raise NotImplementedError
+    def add_many(self, items):
+        """Create the counters of a dict of integers that do not exist yet"""
+        raise NotImplementedError
+    def incr_many(self, keys):
+        """Increment the existing counters of a list of keys"""
+        raise NotImplementedError
+    def clear(self):
+        raise NotImplementedError
+    def size(self):
+        """Get the number of keys stored, None if unknown"""
+        return None
+
+class LocalBackend(CacheBackend):
+    """Bounded LRU of the process
+    Keyword arguments:
+        maxsize -- the maximum number of keys kept, 0 disables the cache
+    """
+    name = 'local'
+    def __init__(self, maxsize=READ_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] is not None and entry[0] <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+        return found
+    def _store(self, key, expires, value):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    def set_many(self, items, ttl):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + ttl
+        with self._lock:
+            for key, value in items.items():
+                self._store(key, expires, value)
+    def add_many(self, items):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for key, value in items.items():
+                if key not in self._entries:
+                    self._store(key, None, value)
+    def incr_many(self, keys):
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries[key] = (entry[0], entry[1] + 1)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    def size(self):
+        return len(self._entries)
+
+class SqliteBackend(CacheBackend):
+    """SQLite file in WAL mode, shared by the processes of a host and kept across restarts
+    Keyword arguments:
+        path -- the path of the database file
+        maxsize -- the number of keys above which the oldest values are deleted
+    """
+    name = 'sqlite'
+    BATCH = 500
+    def __init__(self, path, maxsize=READ_CACHE_SIZE):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value, expires REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)')
+    def _connection(self):
+        # one connection per thread, and a new one in a forked worker
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=READ_CACHE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+    def get_many(self, keys):
+        found = {}
+        try:
+            connection = self._connection()
+            for start in range(0, len(keys), self.BATCH):
+                batch = keys[start:start+self.BATCH]
+                rows = connection.execute(
+                    f'SELECT key, value FROM cache WHERE key IN ({",".join("?" * len(batch))}) AND (expires IS NULL OR expires > ?)',
+                    batch + [time.time()])
+                for key, value in rows:
+                    found[key] = json.loads(value) if isinstance(value, str) else value
+        except sqlite3.Error:
+            logger.exception('Unable to read the cache %s', self.path)
+        return found
+    def set_many(self, items, ttl):
+        if self.maxsize <= 0 or not items:
+            return
+        now = time.time()
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                    [(key, json.dumps(value, separators=(',', ':')), now + ttl) for key, value in items.items()])
+            self._prune(connection, now)
+        except sqlite3.Error:
+            logger.exception('Unable to write the cache %s', self.path)
+    def _prune(self, connection, now):
+        # checked once in a while: the expired values first, then the values closest to expiry
+        if now - getattr(self._local, 'pruned', 0) < 1:
+            return
+        self._local.pruned = now
+        connection.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        excess = connection.execute('SELECT count(*) FROM cache').fetchone()[0] - self.maxsize
+        if excess > 0:
+            connection.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE expires IS NOT NULL ORDER BY expires LIMIT ?)', (excess,))
+    def add_many(self, items):
+        if self.maxsize <= 0:
+            return
+        try:
+            connection = self._connection()
+            connection.executemany('INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?, ?, NULL)', list(items.items()))
+        except sqlite3.Error:
+            logger.exception('Unable to write the cache %s', self.path)
+    def incr_many(self, keys):
+        try:
+            connection = self._connection()
+            connection.executemany('UPDATE cache SET value = value + 1 WHERE key = ?', [(key,) for key in keys])
+        except sqlite3.Error:
+            logger.exception('Unable to write the cache %s', self.path)
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+    def size(self):
+        return self._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+
+class MemcachedBackend(CacheBackend):
+    """Client of the memcached text protocol, shared by every worker; each batch is one round trip
+    Keyword arguments:
+        host -- the host of the memcached server
+        port -- the integer port of the memcached server
+        timeout -- the socket timeout in seconds
+    """
+    name = 'memcached'
+    BATCH = 100
+    def __init__(self, host, port=11211, timeout=READ_CACHE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = (sock, sock.makefile('rb'))
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+    def _call(self, action, default=None):
+        try:
+            return action(*self._connection())
+        except (OSError, ValueError):
+            logger.exception('Unable to reach the cache %s:%s', self.host, self.port)
+            self._close()
+            return default
+    def get_many(self, keys):
+        def get(sock, reader):
+            found = {}
+            for start in range(0, len(keys), self.BATCH):
+                sock.sendall(('get ' + ' '.join(keys[start:start+self.BATCH]) + '\r\n').encode('utf-8'))
+                while True:
+                    line = reader.readline()
+                    if line == b'END\r\n':
+                        break
+                    parts = line.split()
+                    if len(parts) != 4 or parts[0] != b'VALUE':
+                        raise ValueError(f'unexpected reply {line!r}')
+                    data = reader.read(int(parts[3]) + 2)[:-2]
+                    found[parts[1].decode('utf-8')] = json.loads(data)
+            return found
+        return self._call(get, {}) if keys else {}
+    def _pipeline(self, commands):
+        # the commands are sent in one write and their replies read after: one round trip, and
+        # the writes are visible to every worker once the method returns
+        def pipeline(sock, reader):
+            sock.sendall(b''.join(commands))
+            for _ in commands:
+                reader.readline()
+        if commands:
+            self._call(pipeline)
+    def set_many(self, items, ttl):
+        commands = []
+        for key, value in items.items():
+            data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+            commands.append(f'set {key} 0 {max(int(ttl), 1)} {len(data)}\r\n'.encode('utf-8') + data + b'\r\n')
+        self._pipeline(commands)
+    def add_many(self, items):
+        commands = []
+        for key, value in items.items():
+            data = str(value).encode('utf-8')
+            commands.append(f'add {key} 0 0 {len(data)}\r\n'.encode('utf-8') + data + b'\r\n')
+        self._pipeline(commands)
+    def incr_many(self, keys):
+        self._pipeline([f'incr {key} 1\r\n'.encode('utf-8') for key in keys])
+    def clear(self):
+        def flush(sock, reader):
+            sock.sendall(b'flush_all\r\n')
+            reader.readline()
+        self._call(flush)
+
+def create_backend(url=READ_CACHE_URL):
+    """Create the backend of a READ_CACHE_URL: local://, sqlite:///path or memcached://host:port
+    Keyword arguments:
+        url -- the String url of the backend
+    """
+    parsed = urlparse(url or 'local://')
+    if parsed.scheme == 'local':
+        return LocalBackend()
+    if parsed.scheme == 'sqlite':
+        return SqliteBackend(parsed.netloc + parsed.path)
+    if parsed.scheme == 'memcached':
+        return MemcachedBackend(parsed.hostname or 'localhost', parsed.port or 11211)
+    raise ValueError(f'READ_CACHE_URL scheme not supported: {url}')
+
+class ReadCache(object):
+    """Read results stored in a backend, with tag invalidation through generation counters
+    Keyword arguments:
+        backend -- the CacheBackend storing the results
+        ttl -- the number of seconds a result is kept
+        prefix -- the String prefix of the keys, to share a backend between applications
+    """
+    def __init__(self, backend, ttl=READ_CACHE_TTL, prefix=READ_CACHE_PREFIX):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+    def key(self, key):
+        return self.prefix + ':' + '/'.join(str(part) for part in key)
+    def generation_key(self, tag):
+        return self.prefix + ':gen:' + (tag if isinstance(tag, str) else '/'.join(str(part) for part in tag))
+    def get_many(self, entries):
+        """Get the current results of several reads with one lookup in the backend
+        Keyword arguments:
+            entries -- the list of (key, tags, version) of the reads, version is the ETag the
+                result must have been stored with, None for any
+        Returns (found, generations): the dict of the results by key, and the generations to store the missing ones with
+        """
+        tags = list({tag for _, entry_tags, _ in entries for tag in entry_tags})
+        generation_keys = [self.generation_key(tag) for tag in tags]
+        stored = self.backend.get_many([self.key(key) for key, _, _ in entries] + generation_keys)
+        missing = [key for key in generation_keys if key not in stored]
+        if missing:
+            # a new or dropped counter starts at a value no stored result can have
+            start = time.time_ns()
+            self.backend.add_many({key: start for key in missing})
+            stored.update(self.backend.get_many(missing))
+        generations = {tag: stored.get(key) for tag, key in zip(tags, generation_keys)}
+        found = {}
+        for key, entry_tags, version in entries:
+            entry = stored.get(self.key(key))
+            if entry is not None and entry['g'] == [generations[tag] for tag in entry_tags] and None not in entry['g'] \
+                    and (version is None or entry['v'] == version):
+                found[key] = entry['d']
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(entries) - len(found)
+        return found, generations
+    def set_many(self, entries, generations):
+        """Store the results of several reads
+        Keyword arguments:
+            entries -- the list of (key, tags, version, value) of the reads
+            generations -- the generations returned by get_many before the results were loaded
+        """
+        self.backend.set_many({
+            self.key(key): {'g': [generations.get(tag) for tag in tags], 'v': version, 'd': value}
+            for key, tags, version, value in entries if value is not None}, self.ttl)
+    def cached(self, key, tags, load, version=None):
+        """Get a cached result, or load and store it; None results are not stored
+        Keyword arguments:
+            key -- the tuple identifying the read
+            tags -- the tags of the resources the result is built from
+            load -- the function reading the result from the database
+            version -- the current ETag of the result, if known
+        """
+        found, generations = self.get_many([(key, tags, version)])
+        if key in found:
+            return found[key]
+        value = load()
+        self.set_many([(key, tags, version, value)], generations)
+        return value
+    def invalidate(self, *tags):
+        """Drop the results built from the resources of the tags, after a committed write
+        Keyword arguments:
+            tags -- the tags of the resources written
+        """
+        self.backend.incr_many([self.generation_key(tag) for tag in tags])
+        with self._lock:
+            self.invalidations += len(tags)
+    def clear(self):
+        self.backend.clear()
+    def stats(self):
+        """Get the cache counters of the process and the hit ratio
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': self.backend.name,
+                'size': self.backend.size(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,129 @@
+import os
+import zlib
+from flask import request
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+
+The JSON, NDJSON and MessagePack responses are compressed with Brotli when the brotli package
+is installed and the client accepts it, with gzip otherwise. The responses built in memory are
+compressed above COMPRESSION_MIN_SIZE bytes, the streamed responses chunk by chunk, flushed every
+COMPRESSION_FLUSH_SIZE bytes of input so the client keeps receiving complete lines. A response to
+a client accepting a compressed coding has a weak ETag, whether its body is compressed or not, and
+so has its 304: it validates the same entity as the identity response.
+'''
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+COMPRESSION_FLUSH_SIZE = int(os.environ.get('COMPRESSION_FLUSH_SIZE', 65536))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'application/msgpack', 'application/x-msgpack'}
+
+class GzipEncoder(object):
+    """Streaming gzip compressor
+    Keyword arguments:
+        level -- the zlib compression level, 1 to 9
+    """
+    name = 'gzip'
+    def __init__(self, level=COMPRESSION_GZIP_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    def compress(self, data):
+        return self._compressor.compress(data)
+    def flush(self):
+        """Get the pending output, the client can decompress everything sent so far"""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class BrotliEncoder(object):
+    """Streaming Brotli compressor
+    Keyword arguments:
+        quality -- the Brotli quality, 0 to 11
+    """
+    name = 'br'
+    def __init__(self, quality=COMPRESSION_BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+    def compress(self, data):
+        return self._compressor.process(data)
+    def flush(self):
+        return self._compressor.flush()
+    def finish(self):
+        return self._compressor.finish()
+
+encoders = {GzipEncoder.name: GzipEncoder}
+if brotli is not None:
+    encoders[BrotliEncoder.name] = BrotliEncoder
+
+def negotiate_encoding():
+    """Get the content coding the client accepts with the highest quality, Brotli first on a tie,
+    None when the client only accepts the identity
+    """
+    return request.accept_encodings.best_match(sorted(encoders, key=lambda name: name != 'br'))
+
+def accepted_encoding():
+    """The negotiated content coding, None when compression is disabled"""
+    return negotiate_encoding() if COMPRESSION_MIN_SIZE >= 0 else None
+
+def compress_stream(encoder, chunks):
+    """Compress a streamed response chunk by chunk
+    Keyword arguments:
+        encoder -- the GzipEncoder or BrotliEncoder
+        chunks -- the iterable of the response body
+    """
+    try:
+        pending = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = encoder.compress(chunk)
+            pending += len(chunk)
+            if pending >= COMPRESSION_FLUSH_SIZE:
+                data += encoder.flush()
+                pending = 0
+            if data:
+                yield data
+        yield encoder.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def compress_response(response):
+    """Compress the response with the content coding negotiated with the client, after_request hook
+    Keyword arguments:
+        response -- the flask response
+    """
+    if response.status_code == 304:
+        # a 304 has no body, hence no mimetype: it carries the validators of the full response
+        response.vary.add('Accept-Encoding')
+        if accepted_encoding() is not None:
+            weaken_etag(response)
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if encoding is None or request.method == 'HEAD':
+        return response
+    if response.status_code < 200 or response.status_code == 204:
+        return response
+    weaken_etag(response)
+    encoder = encoders[encoding]()
+    if response.is_streamed:
+        response.response = compress_stream(encoder, response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(encoder.compress(data) + encoder.finish())
+    response.headers['Content-Encoding'] = encoding
+    weaken_etag(response)
+    return response
+
+def weaken_etag(response):
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
@@ -4,17 +4,52 @@ import sys
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Movies, Roles, Actors
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import text
+from models import setup_db, db, database_error, read_cache, Movies, Roles, Actors, BULK_MAX_ITEMS, BULK_BATCH_SIZE
+from pool import pool_stats
+from replicas import request_subject
+from graph import casting_graph, GRAPH_MAX_DEPTH
 from responses import Response, AppError
 from authorization import requires_auth
-from datetime import datetime
+from compression import compress_response
+import metrics
+import instrumentation
+from instrumentation import query_budget, QueryBudgetExceeded
+from datetime import datetime, timezone
 
 
 
+# a bulk request draws its ids in one statement, then inserts BULK_BATCH_SIZE rows per statement
+BULK_STATEMENTS = 1 + -(-BULK_MAX_ITEMS // BULK_BATCH_SIZE)
+
+def since_argument():
+    """Read the since query argument of the exports, an ISO 8601 date converted to naive UTC"""
+    since = request.args.get('since', None)
+    if since is None:
+        return None
+    try:
+        since = datetime.fromisoformat(since[:-1] + '+00:00' if since.endswith('Z') else since)
+    except ValueError:
+        raise AppError(title='Wrong Request', detail='since must be an ISO 8601 date', status_code=400)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     setup_db(app)
+    def process_stats():
+        """Get the connection pool, read replicas, read cache and casting graph statistics of the process"""
+        stats = {'database': pool_stats(db.engine), 'readCache': read_cache.stats(), 'castingGraph': casting_graph.stats()}
+        if 'replicas' in app.extensions:
+            stats['replicas'] = app.extensions['replicas'].stats()
+        return stats
+    # Metrics of the requests, first so that its after_request hook sees the final response
+    metrics.init_app(app, process_stats)
+    # Opt-in SQL instrumentation: slow statements, N+1 and query budgets, checked before the commit of the writes
+    instrumentation.init_app(app)
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
     # CORS Headers 
     @app.after_request
@@ -22,44 +57,135 @@ def create_app(test_config=None):
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
         return response
+    # Compression of the JSON, NDJSON and MessagePack responses, with Vary: Accept-Encoding
+    app.after_request(compress_response)
+    # One transaction per request, committed before the response is sent so that a failed
+    # commit is reported to the client; the session is removed at the end of the request
+    @app.after_request
+    def commit_request(response):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return response
+        if response.status_code >= 400:
+            db.session.rollback()
+            return response
+        try:
+            # the statements of the last flush count too: a write over its query budget is not committed
+            db.session.flush()
+            instrumentation.check_request(response)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            error = database_error(e)
+            return app.make_response((Response.error_response(error), error.status_code))
+        except QueryBudgetExceeded:
+            db.session.rollback()
+            raise
+        # the client reads its own writes from the primary for a while
+        if 'replicas' in app.extensions:
+            app.extensions['replicas'].record_write(request_subject())
+        return response
 
 
+    #  Health Endpoint
+    #  ----------------------------------------------------------------
+    @app.route('/health', methods=['GET'])
+    @query_budget(1)
+    def health():
+        """Check the database and report the connection pool, read replicas and read cache statistics of the process"""
+        db.session.execute(text('SELECT 1'))
+        return Response.success_response(process_stats()), 200
+
     #  Movies Endpoints
     #  ----------------------------------------------------------------  
     # start list methods endpoints 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @query_budget(6)
     def get_movies():
         """Retrieve the movies for the page requested in the query
         Keyword arguments:
+            page -- the integer page number, offset pagination
+            per_page -- the integer page size
+            cursor -- the opaque cursor of a previous response, empty for the first page, keyset pagination
+            sort -- the sort key of the keyset pagination: id, name or release
         """
-        page = request.args.get('page', -1, type=int)
-        responseStruct = Movies.read_all(page)
-        if responseStruct is None:
-            raise AppError(title='Wrong Pagination', detail='page not found', status_code=404)
-        return Response.success_response(responseStruct), 200
+        per_page = request.args.get('per_page', None, type=int)
+        if 'cursor' in request.args:
+            # a keyset page is read first, its validators are taken from its rows: no query on the whole table
+            try:
+                responseStruct, validators = Movies.read_page(request.args.get('cursor'), request.args.get('sort', 'id'), per_page, request.query_string)
+            except ValueError as e:
+                raise AppError(title='Wrong Pagination', detail=str(e), status_code=400)
+            return Response.conditional_response(validators, lambda: responseStruct)
+        validators = Movies.list_validators(request.query_string)
+        def build():
+            responseStruct = Movies.read_all(request.args.get('page', -1, type=int), per_page, validators[0])
+            if responseStruct is None:
+                raise AppError(title='Wrong Pagination', detail='page not found', status_code=404)
+            return responseStruct
+        return Response.conditional_response(validators, build)
     
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies():
+        """Stream all the movies as newline-delimited JSON, in id order
+        Keyword arguments:
+            after_id -- only the movies with a greater id
+            until_id -- only the movies with a lower or equal id
+            since -- only the movies modified at or after this ISO 8601 date, UTC when no offset is given
+        """
+        after_id = request.args.get('after_id', None, type=int)
+        until_id = request.args.get('until_id', None, type=int)
+        since = since_argument()
+        return Response.ndjson_response(Movies.export(after_id, until_id, since)), 200
+
     @app.route('/movies/search', methods=['POST'])
     @requires_auth('get:movies')
+    @query_budget(5)
     def search_movies():
         body = request.get_json()
         searchTerm = body.get('searchTerm',None)
         if searchTerm is None:
             raise AppError(title='Wrong Search Request', detail='searchTerm not found in body of the request', status_code=404)
-        responseStruct = Movies.search(searchTerm)
+        page = body.get('page', -1)
+        per_page = body.get('per_page', None)
+        if not isinstance(page, int) or not (per_page is None or isinstance(per_page, int)):
+            raise AppError(title='Wrong Search Request', detail='page and per_page must be integers', status_code=422)
+        responseStruct = Movies.search(searchTerm, page, per_page)
+        if responseStruct is None:
+            raise AppError(title='Wrong Pagination', detail='page not found', status_code=404)
         return Response.success_response(responseStruct), 200
 
     @app.route('/movies/<int:id>/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @query_budget(3)
     def read_movie_actors(id):
-        responseStruct = Movies.read_artists(id)
-        if responseStruct is None:
+        """Retrieve the actors cast in the roles of a movie
+        Keyword arguments:
+            page -- the integer page number
+            per_page -- the integer page size
+            sort -- the sort key: id, name or age
+            order -- asc or desc
+        """
+        page = request.args.get('page', -1, type=int)
+        per_page = request.args.get('per_page', None, type=int)
+        # the cast is part of the movie: any change to it bumps the version of the movie
+        validators = Movies.validators(id, 'actors', request.query_string)
+        if validators is None:
             raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
-        return Response.success_response(responseStruct)
+        def build():
+            try:
+                responseStruct = Movies.read_artists(id, page, per_page, request.args.get('sort', 'id'), request.args.get('order', 'asc') == 'desc', validators[0])
+            except ValueError as e:
+                raise AppError(title='Wrong Request', detail=str(e), status_code=400)
+            if responseStruct is None:
+                raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
+            return responseStruct
+        return Response.conditional_response(validators, build)
 
     # Start of CRUD methods endpoints
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @query_budget(2)
     def create_movie():
         body = request.get_json()
         name = body.get('name',None)
@@ -71,20 +197,36 @@ def create_app(test_config=None):
         release = datetime.fromtimestamp(timestamp)
         movie = Movies(name=name,photo=photoUrl,release=release,genres=genres)
         responseStruct = movie.insert()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 201
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @query_budget(BULK_STATEMENTS)
+    def create_movies():
+        body = request.get_json()
+        items = body.get('movies',None) if isinstance(body, dict) else None
+        if not isinstance(items, list) or len(items) == 0:
+            raise AppError(title='Wrong Create Request', detail='movies array is missing or empty', status_code=422)
+        if len(items) > BULK_MAX_ITEMS:
+            raise AppError(title='Wrong Create Request', detail=f'at most {BULK_MAX_ITEMS} movies per request', status_code=413)
+        results = Movies.bulk_create(items)
+        inserted = sum(1 for result in results if 'id' in result)
+        if inserted == 0:
+            raise AppError(title='Wrong Create Request', detail='; '.join(f"item {result['index']}: {result['error']}" for result in results[:10]), status_code=422)
+        return Response.success_response({'movies': results, 'inserted': inserted, 'failed': len(results) - inserted}), 201
+
     @app.route('/movies/<int:id>', methods=['GET'])
     @requires_auth('get:movies')
+    @query_budget(2)
     def read_movie(id):
-        response_data = Movies.read(id)
-        if response_data is None:
+        validators = Movies.validators(id)
+        if validators is None:
             raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
-        return Response.success_response(response_data) , 200
+        return Response.conditional_response(validators, lambda: Movies.read(id, validators[0]))
 
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @query_budget(2)
     def update_movie(id):
         movie = Movies.get(id)
         if movie is None:
@@ -106,19 +248,16 @@ def create_app(test_config=None):
         if photoUrl is not None:
             movie.photoUrl = photoUrl
         responseStruct = movie.update()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 200
                    
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movies')
+    @query_budget(3)
     def delete_movie(id):   
         movie = Movies.get(id)
         if movie is None:
             raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
         responseStruct = movie.delete()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 200
     
     #  Actors Endpoints
@@ -126,31 +265,80 @@ def create_app(test_config=None):
     # start list methods endpoints 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @query_budget(4)
     def get_actors():
         """Retrieve the actors for the page requested in the query
         Keyword arguments:
+            page -- the integer page number, offset pagination
+            per_page -- the integer page size
+            cursor -- the opaque cursor of a previous response, empty for the first page, keyset pagination
+            sort -- the sort key of the keyset pagination: id, name or age
         """
-        page = request.args.get('page', -1, type=int)
-        responseStruct = Actors.read_all(page)
-        if responseStruct is None:
-            raise AppError(title='Wrong Pagination', detail='Page requested does not exist', status_code=404)
-        return Response.success_response(responseStruct), 200        
+        per_page = request.args.get('per_page', None, type=int)
+        if 'cursor' in request.args:
+            # a keyset page is read first, its validators are taken from its rows: no query on the whole table
+            try:
+                responseStruct, validators = Actors.read_page(request.args.get('cursor'), request.args.get('sort', 'id'), per_page, request.query_string)
+            except ValueError as e:
+                raise AppError(title='Wrong Pagination', detail=str(e), status_code=400)
+            return Response.conditional_response(validators, lambda: responseStruct)
+        validators = Actors.list_validators(request.query_string)
+        def build():
+            responseStruct = Actors.read_all(request.args.get('page', -1, type=int), per_page, validators[0])
+            if responseStruct is None:
+                raise AppError(title='Wrong Pagination', detail='Page requested does not exist', status_code=404)
+            return responseStruct
+        return Response.conditional_response(validators, build)        
     
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors():
+        """Stream all the actors as newline-delimited JSON, in id order
+        Keyword arguments:
+            after_id -- only the actors with a greater id
+            until_id -- only the actors with a lower or equal id
+            since -- only the actors modified at or after this ISO 8601 date, UTC when no offset is given
+        """
+        after_id = request.args.get('after_id', None, type=int)
+        until_id = request.args.get('until_id', None, type=int)
+        since = since_argument()
+        return Response.ndjson_response(Actors.export(after_id, until_id, since)), 200
+
     @app.route('/actors/search', methods=['POST'])
     @requires_auth('get:actors')
+    @query_budget(3)
     def search_actors():
         body = request.get_json()
         searchName = body.get('searchName',None)
         searchGender = body.get('searchGender',None)
         searchAge = body.get('searchAge',None)
-        if searchName is None and searchGender is None and searchAge is None:
+        searchAgeMin = body.get('searchAgeMin',None)
+        searchAgeMax = body.get('searchAgeMax',None)
+        if searchName is None and searchGender is None and searchAge is None and searchAgeMin is None and searchAgeMax is None:
             raise AppError(title='Wrong Search Request', detail='all search types are missing', status_code=422)
-        responseStruct = Actors.search(searchName=searchName,searchGender=searchGender,searchAge=searchAge)
+        for age in [searchAge, searchAgeMin, searchAgeMax]:
+            if age is not None and not isinstance(age, int):
+                raise AppError(title='Wrong Search Request', detail='searchAge, searchAgeMin and searchAgeMax must be integers', status_code=422)
+        if isinstance(searchGender, list) and not all(isinstance(gender, str) for gender in searchGender):
+            raise AppError(title='Wrong Search Request', detail='searchGender must be a String or an array of Strings', status_code=422)
+        page = body.get('page', -1)
+        per_page = body.get('per_page', None)
+        if not isinstance(page, int) or not (per_page is None or isinstance(per_page, int)):
+            raise AppError(title='Wrong Search Request', detail='page and per_page must be integers', status_code=422)
+        try:
+            responseStruct = Actors.search(searchName=searchName,searchGender=searchGender,searchAge=searchAge,
+                searchAgeMin=searchAgeMin,searchAgeMax=searchAgeMax,sort=body.get('sort',None),descending=body.get('order','asc') == 'desc',
+                page=page,per_page=per_page)
+        except ValueError as e:
+            raise AppError(title='Wrong Search Request', detail=str(e), status_code=422)
+        if responseStruct is None:
+            raise AppError(title='Wrong Pagination', detail='page not found', status_code=404)
         return Response.success_response(responseStruct), 200        
 
     # Start of CRUD methods endpoints
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @query_budget(1)
     def create_actor():
         body = request.get_json()
         name = body.get('name',None)
@@ -161,20 +349,86 @@ def create_app(test_config=None):
             raise AppError(title='Wrong Create Request', detail='Name, Gender or Age is missing', status_code=422)
         actor = Actors(name=name,photo=photoUrl,gender=gender,age=age)
         responseStruct = actor.insert()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 201
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @query_budget(BULK_STATEMENTS)
+    def create_actors():
+        body = request.get_json()
+        items = body.get('actors',None) if isinstance(body, dict) else None
+        if not isinstance(items, list) or len(items) == 0:
+            raise AppError(title='Wrong Create Request', detail='actors array is missing or empty', status_code=422)
+        if len(items) > BULK_MAX_ITEMS:
+            raise AppError(title='Wrong Create Request', detail=f'at most {BULK_MAX_ITEMS} actors per request', status_code=413)
+        results = Actors.bulk_create(items)
+        inserted = sum(1 for result in results if 'id' in result)
+        if inserted == 0:
+            raise AppError(title='Wrong Create Request', detail='; '.join(f"item {result['index']}: {result['error']}" for result in results[:10]), status_code=422)
+        return Response.success_response({'actors': results, 'inserted': inserted, 'failed': len(results) - inserted}), 201
+
     @app.route('/actors/<int:id>', methods=['GET'])
     @requires_auth('get:actors')
+    @query_budget(2)
     def read_actor(id):
-        response_data = Actors.read(id)
-        if response_data is None:
+        validators = Actors.validators(id)
+        if validators is None:
+            raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
+        return Response.conditional_response(validators, lambda: Actors.read(id, validators[0]))
+
+    # the SQL answering the casting graph queries while the graph is read costs a statement more
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @query_budget(4)
+    def read_actor_movies(id):
+        """Retrieve the movies an actor is cast in, the latest release first, with its roles; the
+        castings committed by other processes appear after GRAPH_REFRESH seconds at most
+        Keyword arguments:
+            page -- the integer page number
+            per_page -- the integer page size
+        """
+        page = request.args.get('page', -1, type=int)
+        per_page = request.args.get('per_page', None, type=int)
+        responseStruct = Actors.read_movies(id, page, per_page)
+        if responseStruct is None:
+            raise AppError(title='Wrong Id', detail='Id request not found or page out of range', status_code=404)
+        return Response.success_response(responseStruct), 200
+
+    @app.route('/actors/<int:id>/costars', methods=['GET'])
+    @requires_auth('get:actors')
+    @query_budget(2)
+    def read_actor_costars(id):
+        """Retrieve the actors sharing a movie with an actor, the most shared movies first; the
+        castings committed by other processes appear after GRAPH_REFRESH seconds at most
+        Keyword arguments:
+            page -- the integer page number
+            per_page -- the integer page size
+        """
+        page = request.args.get('page', -1, type=int)
+        per_page = request.args.get('per_page', None, type=int)
+        responseStruct = Actors.read_costars(id, page, per_page)
+        if responseStruct is None:
+            raise AppError(title='Wrong Id', detail='Id request not found or page out of range', status_code=404)
+        return Response.success_response(responseStruct), 200
+
+    # and a statement per level of the search for a path
+    @app.route('/actors/<int:id>/path/<int:other_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @query_budget(2 + GRAPH_MAX_DEPTH)
+    def read_actors_path(id, other_id):
+        """Retrieve a shortest chain of actors and shared movies from an actor to another; the
+        castings committed by other processes appear after GRAPH_REFRESH seconds at most
+        """
+        responseStruct = Actors.read_path(id, other_id)
+        if responseStruct is None:
             raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
-        return Response.success_response(response_data) , 200
+        if responseStruct['path'] is None:
+            raise AppError(title='No Path', detail=f'the actors are not linked by {GRAPH_MAX_DEPTH} movies or less', status_code=404)
+        return Response.success_response(responseStruct), 200
 
     @app.route('/actors/<int:id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @query_budget(4)
     def update_actor(id):  
         actor = Actors.get(id)
         if actor is None:
@@ -195,19 +449,16 @@ def create_app(test_config=None):
         if photoUrl is not None:
             actor.photoUrl = photoUrl
         responseStruct = actor.update()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 200
     
     @app.route('/actors/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actors')
+    @query_budget(6)
     def delete_actor(id): 
         actor = Actors.get(id)
         if actor is None:
             raise AppError(title='Wrong Id', detail='Id request not found', status_code=404)
         responseStruct = actor.delete()
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 200
 
     #  Roles Endpoints
@@ -215,6 +466,7 @@ def create_app(test_config=None):
     # Start of CRUD methods endpoints
     @app.route('/roles', methods=['POST'])
     @requires_auth('post:roles')
+    @query_budget(5)
     def create_role():
         body = request.get_json()
         name = body.get('name',None)
@@ -229,13 +481,12 @@ def create_app(test_config=None):
         movie.roles.append(role)
 
         responseStruct = role.insert()
-        
-        if responseStruct is None:
-            raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 201
         
+    # a casting reads the id of its transaction for the casting graph
     @app.route('/roles/<int:id>', methods=['PATCH'])
     @requires_auth('patch:roles')
+    @query_budget(6)
     def update_role(id):
         body = request.get_json()
         name = body.get('name',None)
@@ -256,8 +507,6 @@ def create_app(test_config=None):
                 raise AppError(title='Wrong Patch Request', detail='Actor with requested ID does not exist', status_code=422)
             role.actors.append(actor)
         responseStruct = role.update()
-        if responseStruct is None:
-             raise AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
         return Response.success_response(responseStruct), 200    
 
     #  Error Handlers
@@ -265,4 +514,9 @@ def create_app(test_config=None):
     @app.errorhandler(AppError)
     def response_error(e):
         return Response.error_response(e), e.status_code
+
+    @app.errorhandler(SQLAlchemyError)
+    def database_failure(e):
+        error = database_error(e)
+        return Response.error_response(error), error.status_code
     return app
\ No newline at end of file
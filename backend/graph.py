@@ -0,0 +1,402 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from sqlalchemy import text
+
+'''
+Casting graph
+
+The castings form a graph of actors and movies: an actor is linked to the movies of the roles
+it is cast in (actors_for_roles and Roles.movie_id). The graph is kept in memory as two
+compressed sparse rows of integer arrays, actor to movies and movie to actors, indexed by id,
+with the number of roles of each link: a few bytes per link, and the neighbours of a node are
+a slice. The castings committed by the process are applied at once to an overlay of the rows;
+the graph is read again from the database every GRAPH_REFRESH seconds, in the background,
+which brings in the castings of the other workers and of manage.py import, or sooner once
+the overlay holds GRAPH_OVERLAY_LIMIT links. Each worker reads the whole graph: the castings
+committed by the other processes are seen by the casting graph endpoints GRAPH_REFRESH seconds
+later at most, plus the time of a read.
+
+The graph is read in the background, the first time too: until it is ready the same queries
+are answered by DatabaseGraph, in SQL. A read records its snapshot, and the castings committed
+by the process while it runs are applied to its result unless their transaction is visible in
+the snapshot, so that no casting is counted twice or lost.
+'''
+GRAPH_REFRESH = float(os.environ.get('GRAPH_REFRESH', 300))
+GRAPH_OVERLAY_LIMIT = int(os.environ.get('GRAPH_OVERLAY_LIMIT', 100000))
+GRAPH_MAX_DEPTH = int(os.environ.get('GRAPH_MAX_DEPTH', 6))
+
+logger = logging.getLogger(__name__)
+
+CASTINGS_QUERY = '''SELECT actors_for_roles.actor_id, "Roles".movie_id, count(*) FROM actors_for_roles JOIN "Roles" ON "Roles".id = actors_for_roles.role_id
+    GROUP BY 1, 2 ORDER BY 1, 2'''
+READ_ROWS = 50000
+
+ACTOR_MOVIES_QUERY = '''SELECT DISTINCT "Roles".movie_id FROM actors_for_roles JOIN "Roles" ON "Roles".id = actors_for_roles.role_id
+    WHERE actors_for_roles.actor_id = :actor_id ORDER BY 1'''
+COSTARS_QUERY = '''SELECT costars.actor_id, count(DISTINCT roles.movie_id) FROM actors_for_roles casting
+    JOIN "Roles" roles ON roles.id = casting.role_id
+    JOIN "Roles" movie_roles ON movie_roles.movie_id = roles.movie_id
+    JOIN actors_for_roles costars ON costars.role_id = movie_roles.id
+    WHERE casting.actor_id = :actor_id AND costars.actor_id <> :actor_id GROUP BY 1'''
+EXPAND_QUERY = '''SELECT DISTINCT casting.actor_id, roles.movie_id, costars.actor_id FROM actors_for_roles casting
+    JOIN "Roles" roles ON roles.id = casting.role_id
+    JOIN "Roles" movie_roles ON movie_roles.movie_id = roles.movie_id
+    JOIN actors_for_roles costars ON costars.role_id = movie_roles.id
+    WHERE casting.actor_id = ANY(:actor_ids) AND roles.movie_id <> ALL(:visited_movies) ORDER BY 1, 2, 3'''
+
+def read_snapshot(value):
+    """Read a txid_current_snapshot() value, xmin:xmax:xip,..., as (xmin, xmax, in progress ids)"""
+    xmin, xmax, in_progress = value.split(':')
+    return int(xmin), int(xmax), frozenset(int(txid) for txid in in_progress.split(',') if txid)
+
+class Adjacency(object):
+    """Compressed sparse rows: the targets of node n are targets[offsets[n]:offsets[n + 1]], in
+    increasing order, with the number of roles of each link in weights
+    """
+    def __init__(self):
+        self.offsets = array('q', [0])
+        self.targets = array('i')
+        self.weights = array('i')
+        self.nodes = 0
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the rows from (source, target, weight) sorted by source and target"""
+        adjacency = cls()
+        offsets, targets, weights = adjacency.offsets, adjacency.targets, adjacency.weights
+        for source, target, weight in rows:
+            if len(offsets) <= source:
+                adjacency.nodes += 1
+            while len(offsets) <= source:
+                offsets.append(len(targets))
+            targets.append(target)
+            weights.append(weight)
+        offsets.append(len(targets))
+        return adjacency
+    def transposed(self):
+        """Build the rows of the opposite direction, with a counting sort of the targets"""
+        transposed = Adjacency()
+        size = max(self.targets) + 1 if self.targets else 0
+        counts = array('q', [0]) * (size + 1)
+        for target in self.targets:
+            counts[target + 1] += 1
+        transposed.nodes = sum(1 for count in counts if count)
+        for node in range(size):
+            counts[node + 1] += counts[node]
+        transposed.offsets = counts
+        positions = array('q', counts)
+        targets, weights = array('i', [0]) * len(self.targets), array('i', [0]) * len(self.targets)
+        offsets = self.offsets
+        for source in range(len(offsets) - 1):
+            for link in range(offsets[source], offsets[source + 1]):
+                target = self.targets[link]
+                position = positions[target]
+                targets[position] = source
+                weights[position] = self.weights[link]
+                positions[target] = position + 1
+        transposed.targets, transposed.weights = targets, weights
+        return transposed
+    def links(self, node):
+        """Get the (targets, weights) of a node"""
+        if node < 0 or node + 1 >= len(self.offsets):
+            return self.targets[:0], self.weights[:0]
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:end], self.weights[start:end]
+    @property
+    def size(self):
+        return len(self.targets)
+
+class CastingLinks(object):
+    """The queries of the casting graph, over the expand method of the subclasses"""
+    def expand(self, actor_ids, visited_movies):
+        """Iterate over the (actor, movie, costar) of the movies of actors not visited yet, and
+        add these movies to visited_movies
+        """
+        raise NotImplementedError
+    def path(self, source, target, max_depth=GRAPH_MAX_DEPTH):
+        """Find a shortest chain of actors and shared movies between two actors, with a
+        bidirectional breadth-first search expanding the smaller frontier first
+        Keyword arguments:
+            source -- the integer id of the first actor
+            target -- the integer id of the last actor
+            max_depth -- the largest number of movies in the chain
+        Returns the list of ids [actor, movie, actor, ..., movie, actor], None when there is none
+        """
+        if source == target:
+            return [source]
+        # actor -> (movie, previous actor, depth) of each side
+        parents = ({source: (None, None, 0)}, {target: (None, None, 0)})
+        frontiers = ([source], [target])
+        visited_movies = (set(), set())
+        depth = 0
+        while depth < max_depth and frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other, movies = parents[side], parents[1 - side], visited_movies[side]
+            level = seen[frontiers[side][0]][2] + 1
+            frontier = []
+            meetings = []
+            for actor_id, movie_id, costar in self.expand(frontiers[side], movies):
+                if costar in seen:
+                    continue
+                seen[costar] = (movie_id, actor_id, level)
+                if costar in other:
+                    meetings.append(costar)
+                frontier.append(costar)
+            frontiers = (frontier, frontiers[1]) if side == 0 else (frontiers[0], frontier)
+            depth += 1
+            if meetings:
+                # the whole level is expanded: the meeting closest to the other end is the shortest
+                meeting = min(meetings, key=lambda actor_id: (other[actor_id][2], actor_id))
+                return self._chain(parents[0], meeting) + list(reversed(self._chain(parents[1], meeting)))[1:]
+        return None
+    @staticmethod
+    def _chain(parents, actor_id):
+        """The ids from the start of a side to an actor it reached"""
+        chain = [actor_id]
+        movie_id, previous, _ = parents[actor_id]
+        while previous is not None:
+            chain[:0] = [previous, movie_id]
+            movie_id, previous, _ = parents[previous]
+        return chain
+
+class GraphIndex(CastingLinks):
+    """A snapshot of the castings and the overlay of the castings committed since
+    Keyword arguments:
+        actor_movies -- the Adjacency of the actors to their movies
+        movie_actors -- the Adjacency of the movies to their actors
+        snapshot -- the (xmin, xmax, in progress ids) of the transaction that read them, see read_snapshot
+    """
+    def __init__(self, actor_movies, movie_actors, snapshot=None):
+        self.actor_movies = actor_movies
+        self.movie_actors = movie_actors
+        self.snapshot = snapshot
+        self.built_at = time.monotonic()
+        # node -> {target: change of the number of roles}, replaced (never updated in place) by apply;
+        # a drop removes the links of its neighbours there, and empties its own row
+        self.actor_changes = {}
+        self.movie_changes = {}
+        self.dropped_actors = frozenset()
+        self.dropped_movies = frozenset()
+        self.overlay = 0
+    @staticmethod
+    def _counts(adjacency, changes, node):
+        """Get the {target: number of roles} of a node, with its changes"""
+        targets, weights = adjacency.links(node)
+        counts = dict(zip(targets, weights))
+        for target, change in changes.get(node, {}).items():
+            counts[target] = counts.get(target, 0) + change
+        return counts
+    @staticmethod
+    def _neighbours(adjacency, changes, dropped_nodes, node):
+        if node in dropped_nodes:
+            return []
+        if node not in changes:
+            return adjacency.links(node)[0]
+        return sorted(target for target, count in GraphIndex._counts(adjacency, changes, node).items() if count > 0)
+    def movies_of(self, actor_id):
+        """Get the ids of the movies an actor is cast in, in increasing order"""
+        return self._neighbours(self.actor_movies, self.actor_changes, self.dropped_actors, actor_id)
+    def actors_of(self, movie_id):
+        """Get the ids of the actors cast in a movie, in increasing order"""
+        return self._neighbours(self.movie_actors, self.movie_changes, self.dropped_movies, movie_id)
+    @staticmethod
+    def _change(node_changes, node, target, roles):
+        updated = dict(node_changes.get(node, {}))
+        updated[target] = updated.get(target, 0) + roles
+        node_changes[node] = updated
+    def _drop(self, node, adjacency, changes, target_changes):
+        """Remove the links of a dropped node from the rows of its neighbours only: the other
+        nodes keep their rows as they were read
+        """
+        for target, count in self._counts(adjacency, changes, node).items():
+            if count > 0:
+                self._change(target_changes, target, node, -count)
+                self.overlay += 1
+    def apply(self, changes):
+        """Apply committed casting changes, see graph_on_commit in models"""
+        for change in changes:
+            if change[0] == 'cast':
+                _, actor_id, movie_id, roles = change
+                self._change(self.actor_changes, actor_id, movie_id, roles)
+                self._change(self.movie_changes, movie_id, actor_id, roles)
+                self.overlay += 1
+            elif change[0] == 'drop_actor':
+                if change[1] not in self.dropped_actors:
+                    self._drop(change[1], self.actor_movies, self.actor_changes, self.movie_changes)
+                    self.dropped_actors = self.dropped_actors | {change[1]}
+            elif change[0] == 'drop_movie':
+                if change[1] not in self.dropped_movies:
+                    self._drop(change[1], self.movie_actors, self.movie_changes, self.actor_changes)
+                    self.dropped_movies = self.dropped_movies | {change[1]}
+    def costars(self, actor_id):
+        """Get the {actor id: number of movies shared} of the actors sharing a movie with an actor"""
+        shared = {}
+        for movie_id in self.movies_of(actor_id):
+            for costar in self.actors_of(movie_id):
+                if costar != actor_id:
+                    shared[costar] = shared.get(costar, 0) + 1
+        return shared
+    def expand(self, actor_ids, visited_movies):
+        for actor_id in actor_ids:
+            for movie_id in self.movies_of(actor_id):
+                if movie_id in visited_movies:
+                    continue
+                visited_movies.add(movie_id)
+                for costar in self.actors_of(movie_id):
+                    yield actor_id, movie_id, costar
+    def covers(self, txid):
+        """Whether the castings of a committed transaction were read in the snapshot
+        Keyword arguments:
+            txid -- the txid_current() of the transaction, None when unknown
+        """
+        if self.snapshot is None or txid is None:
+            return False
+        xmin, xmax, in_progress = self.snapshot
+        return txid < xmin or (txid < xmax and txid not in in_progress)
+    def stats(self):
+        return {
+            'actors': self.actor_movies.nodes,
+            'movies': self.movie_actors.nodes,
+            'links': self.actor_movies.size,
+            'overlay': self.overlay,
+            'age_seconds': round(time.monotonic() - self.built_at, 1),
+        }
+
+def read_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(READ_ROWS)
+        if not rows:
+            return
+        yield from rows
+
+def read_index(engine):
+    """Read the castings from the database and build a GraphIndex, with a server-side cursor of
+    the DBAPI connection, in a repeatable read transaction whose snapshot is recorded
+    """
+    started = time.monotonic()
+    connection = engine.raw_connection()
+    try:
+        # the checkout may have begun a transaction, the isolation level is set by the first statement
+        connection.rollback()
+        cursor = connection.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        # the read takes seconds on millions of castings
+        cursor.execute('SET LOCAL statement_timeout = 0')
+        cursor.execute('SELECT txid_current_snapshot()::text')
+        snapshot = read_snapshot(cursor.fetchone()[0])
+        cursor.close()
+        cursor = connection.cursor('casting_graph')
+        cursor.execute(CASTINGS_QUERY)
+        actor_movies = Adjacency.from_rows(read_rows(cursor))
+        cursor.close()
+        connection.commit()
+    finally:
+        connection.close()
+    index = GraphIndex(actor_movies, actor_movies.transposed(), snapshot)
+    logger.info('casting graph: %s links read in %.2fs', actor_movies.size, time.monotonic() - started)
+    return index
+
+class DatabaseGraph(CastingLinks):
+    """The queries of the casting graph answered in SQL, while the GraphIndex is read
+    Keyword arguments:
+        session -- the session of the request
+    """
+    def __init__(self, session):
+        self.session = session
+    def movies_of(self, actor_id):
+        return [row[0] for row in self.session.execute(text(ACTOR_MOVIES_QUERY), {'actor_id': actor_id})]
+    def costars(self, actor_id):
+        return dict(self.session.execute(text(COSTARS_QUERY), {'actor_id': actor_id}).fetchall())
+    def expand(self, actor_ids, visited_movies):
+        """One statement per level of the search"""
+        rows = self.session.execute(text(EXPAND_QUERY), {'actor_ids': list(actor_ids), 'visited_movies': list(visited_movies)}).fetchall()
+        # a movie is expanded from the first actor of the level reaching it, as in GraphIndex
+        expanded = set()
+        for actor_id, movie_id, costar in rows:
+            if movie_id not in visited_movies:
+                visited_movies.add(movie_id)
+                expanded.add((actor_id, movie_id))
+            if (actor_id, movie_id) in expanded:
+                yield actor_id, movie_id, costar
+
+class CastingGraph(object):
+    """The casting graph of the process, read and refreshed in the background
+    Keyword arguments:
+        refresh -- the seconds after which the graph is read again from the database
+        overlay_limit -- the number of committed castings after which the graph is read again
+    """
+    def __init__(self, refresh=GRAPH_REFRESH, overlay_limit=GRAPH_OVERLAY_LIMIT):
+        self.refresh = refresh
+        self.overlay_limit = overlay_limit
+        self.index = None
+        self.builds = 0
+        self.build_seconds = 0.0
+        # the (txid, changes) committed while a read runs, applied to its result unless it saw them
+        self._pending = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+    def current(self, engine):
+        """Get the GraphIndex, None until the first read is done; the read is started in the
+        background on first use, and again once the graph is stale
+        Keyword arguments:
+            engine -- the engine of the primary database
+        """
+        index = self.index
+        if index is None or time.monotonic() - index.built_at >= self.refresh or index.overlay >= self.overlay_limit:
+            if self._build_lock.acquire(blocking=False):
+                threading.Thread(target=self._refresh, args=(engine,), name='casting-graph', daemon=True).start()
+        return index
+    def _refresh(self, engine):
+        try:
+            self._read(engine)
+        except Exception:
+            logger.exception('the casting graph could not be read')
+        finally:
+            self._build_lock.release()
+    def rebuild(self, engine):
+        """Read the graph from the database and replace the current one, after the read running"""
+        with self._build_lock:
+            self._read(engine)
+    def _read(self, engine):
+        started = time.monotonic()
+        with self._lock:
+            self._pending = []
+        try:
+            index = read_index(engine)
+        except:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for txid, changes in self._pending:
+                if not index.covers(txid):
+                    index.apply(changes)
+            self._pending = None
+            self.index = index
+            self.builds += 1
+            self.build_seconds = time.monotonic() - started
+    def apply(self, changes, txid=None):
+        """Apply the casting changes of a committed transaction
+        Keyword arguments:
+            changes -- the list of ('cast', actor id, movie id, roles added or removed),
+                       ('drop_actor', actor id) and ('drop_movie', movie id)
+            txid -- the txid_current() of the transaction
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((txid, changes))
+            if self.index is not None:
+                self.index.apply(changes)
+    def clear(self):
+        with self._lock:
+            self.index = None
+    def stats(self):
+        index = self.index
+        stats = {'ready': index is not None, 'builds': self.builds, 'build_seconds': round(self.build_seconds, 3)}
+        if index is not None:
+            stats.update(index.stats())
+        return stats
+
+casting_graph = CastingGraph()
@@ -0,0 +1,227 @@
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from models import db, BUMP_LIST_GENERATIONS
+
+'''
+Streaming bulk import
+
+The file is read CHECKPOINT_ROWS records at a time. Each chunk is copied with COPY into a
+temporary staging table, merged into the tables with one set-based INSERT ... ON CONFLICT, and
+committed together with the number of records done in import_checkpoints. Memory stays bounded
+by the chunk size whatever the file size, and an interrupted import resumes after the last
+committed chunk. Rows with an id are upserted, rows without an id get the next id of the table;
+when a chunk holds the same id more than once, its last line wins. Updated rows get a new version,
+and the movies whose cast changed are touched, like the API does: a role moved to another movie
+leaves the old one, and both are touched. Each chunk bumps the generations of the lists it changed.
+'''
+CHECKPOINT_ROWS = int(os.environ.get('IMPORT_CHECKPOINT_ROWS', 10000))
+
+TOUCH_MOVIES = '''UPDATE "Movies" SET version = version + 1, updated_at = timezone('utc', now())'''
+
+# The staged rows, keeping the last line of each id (an upsert cannot affect the same row twice)
+LATEST_STAGED = '''(SELECT DISTINCT ON (id, CASE WHEN id IS NULL THEN line END) * FROM import_staging
+    ORDER BY id, CASE WHEN id IS NULL THEN line END, line DESC) AS staged'''
+
+KINDS = {
+    'movies': {
+        'columns': [('id', 'integer'), ('name', 'varchar(150)'), ('photoUrl', 'varchar'), ('release', 'timestamp'), ('genres', 'varchar[]')],
+        'merge': f'''
+            INSERT INTO "Movies" (id, name, "photoUrl", release, genres)
+            SELECT coalesce(id, nextval(pg_get_serial_sequence('"Movies"', 'id'))), name, coalesce("photoUrl", ''), release, coalesce(genres, '{{}}')
+            FROM {LATEST_STAGED}
+            ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, "photoUrl" = EXCLUDED."photoUrl", release = EXCLUDED.release, genres = EXCLUDED.genres,
+                version = "Movies".version + 1, updated_at = timezone('utc', now())
+        ''',
+        'sequence': ('Movies', 'id'),
+        'lists': ['movies'],
+    },
+    'actors': {
+        'columns': [('id', 'integer'), ('name', 'varchar(150)'), ('photoUrl', 'varchar'), ('gender', 'varchar'), ('age', 'integer')],
+        'merge': f'''
+            WITH merged AS (
+                INSERT INTO "Actors" (id, name, "photoUrl", gender, age)
+                SELECT coalesce(id, nextval(pg_get_serial_sequence('"Actors"', 'id'))), name, coalesce("photoUrl", ''), gender, age
+                FROM {LATEST_STAGED}
+                ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, "photoUrl" = EXCLUDED."photoUrl", gender = EXCLUDED.gender, age = EXCLUDED.age,
+                    version = "Actors".version + 1, updated_at = timezone('utc', now())
+                RETURNING id
+            )
+            {TOUCH_MOVIES} WHERE id IN (
+                SELECT roles_in_movies.movie_id FROM roles_in_movies
+                JOIN actors_for_roles ON actors_for_roles.role_id = roles_in_movies.role_id
+                WHERE actors_for_roles.actor_id IN (SELECT id FROM merged))
+        ''',
+        'sequence': ('Actors', 'id'),
+        'lists': ['actors', 'movies'],
+    },
+    'roles': {
+        'columns': [('id', 'integer'), ('name', 'varchar(150)'), ('types', 'varchar'), ('movie_id', 'integer')],
+        'merge': f'''
+            WITH merged AS (
+                INSERT INTO "Roles" (id, name, types, movie_id)
+                SELECT coalesce(id, nextval(pg_get_serial_sequence('"Roles"', 'id'))), name, types, movie_id
+                FROM {LATEST_STAGED}
+                ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, types = EXCLUDED.types, movie_id = EXCLUDED.movie_id
+                RETURNING id, movie_id
+            ), unlinked AS (
+                DELETE FROM roles_in_movies USING merged
+                WHERE roles_in_movies.role_id = merged.id AND roles_in_movies.movie_id <> merged.movie_id
+                RETURNING roles_in_movies.movie_id
+            ), linked AS (
+                INSERT INTO roles_in_movies (movie_id, role_id)
+                SELECT movie_id, id FROM merged
+                ON CONFLICT DO NOTHING
+            )
+            {TOUCH_MOVIES} WHERE id IN (SELECT movie_id FROM merged UNION SELECT movie_id FROM unlinked)
+        ''',
+        'sequence': ('Roles', 'id'),
+        'lists': ['movies'],
+    },
+    'castings': {
+        'columns': [('role_id', 'integer'), ('actor_id', 'integer')],
+        'merge': f'''
+            WITH linked AS (
+                INSERT INTO actors_for_roles (role_id, actor_id)
+                SELECT DISTINCT role_id, actor_id FROM import_staging
+                ON CONFLICT DO NOTHING
+                RETURNING role_id
+            )
+            {TOUCH_MOVIES} WHERE id IN (SELECT movie_id FROM "Roles" WHERE id IN (SELECT role_id FROM linked))
+        ''',
+        'sequence': None,
+        'lists': ['movies'],
+    },
+}
+
+def array_literal(values):
+    """Format a list of Strings as a Postgres array literal"""
+    items = ['"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for value in values]
+    return '{' + ','.join(items) + '}'
+
+def normalize(kind, record):
+    """Convert a CSV or NDJSON record to the staging columns of the kind
+    Keyword arguments:
+        kind -- the String kind of the file
+        record -- the dict read from the file
+    """
+    row = []
+    for column, column_type in KINDS[kind]['columns']:
+        value = record.get(column, None)
+        if value == '':
+            value = None
+        if column == 'release' and value is None and record.get('timestamp', None) not in (None, ''):
+            value = datetime.fromtimestamp(float(record['timestamp'])).isoformat()
+        if column == 'photoUrl' and value is None:
+            value = record.get('photourl', None)
+        if column_type.endswith('[]') and value is not None:
+            if isinstance(value, str):
+                value = [item for item in value.split('|') if item]
+            value = array_literal(value)
+        row.append(value)
+    return row
+
+def read_records(path, file_format):
+    """Iterate over the records of a CSV (with a header line) or NDJSON file
+    Keyword arguments:
+        path -- the path of the file
+        file_format -- 'csv' or 'ndjson'
+    """
+    with open(path, newline='', encoding='utf-8') as source:
+        if file_format == 'csv':
+            for record in csv.DictReader(source):
+                yield record
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+def copy_chunk(cursor, kind, rows):
+    """COPY a chunk of rows into the staging table
+    Keyword arguments:
+        cursor -- the psycopg2 cursor
+        kind -- the String kind of the file
+        rows -- the list of normalized rows
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    columns = ', '.join(f'"{column}"' for column, _ in KINDS[kind]['columns'])
+    cursor.copy_expert(f'COPY import_staging ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+def import_file(kind, path, file_format=None, checkpoint=CHECKPOINT_ROWS, restart=False, out=print):
+    """Stream a file of movies, actors, roles or castings into the database
+    Keyword arguments:
+        kind -- 'movies', 'actors', 'roles' or 'castings'
+        path -- the path of the CSV or NDJSON file
+        file_format -- 'csv' or 'ndjson', guessed from the file extension by default
+        checkpoint -- the number of records per committed chunk
+        restart -- True to ignore the checkpoint of a previous run
+        out -- the function printing the progress
+    Returns the number of records imported by this run
+    """
+    if kind not in KINDS:
+        raise ValueError(f'kind must be one of {", ".join(KINDS)}')
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    source = f'{kind}:{os.path.abspath(path)}'
+    stat = os.stat(path)
+    fingerprint = f'{stat.st_size}:{int(stat.st_mtime)}'
+    columns = ', '.join(f'"{column}" {column_type}' for column, column_type in KINDS[kind]['columns'])
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS import_checkpoints (
+            source varchar PRIMARY KEY, fingerprint varchar NOT NULL, records integer NOT NULL, updated_at timestamp NOT NULL)''')
+        cursor.execute('SELECT fingerprint, records FROM import_checkpoints WHERE source = %s', (source,))
+        saved = cursor.fetchone()
+        done = saved[1] if saved is not None and saved[0] == fingerprint and not restart else 0
+        connection.commit()
+        if done:
+            out(f'{kind}: resuming after {done} records')
+
+        started = time.monotonic()
+        imported = 0
+        records = read_records(path, file_format)
+        for _ in range(done):
+            next(records, None)
+        chunk = []
+        for record in records:
+            chunk.append(normalize(kind, record))
+            if len(chunk) >= checkpoint:
+                done, imported = commit_chunk(cursor, connection, kind, columns, chunk, source, fingerprint, done, imported)
+                chunk = []
+                elapsed = time.monotonic() - started
+                out(f'{kind}: {done} records, {imported / elapsed:.0f} rows/sec')
+        if chunk:
+            done, imported = commit_chunk(cursor, connection, kind, columns, chunk, source, fingerprint, done, imported)
+        sequence = KINDS[kind]['sequence']
+        if sequence is not None:
+            table, column = sequence
+            cursor.execute(f'''SELECT setval(pg_get_serial_sequence('"{table}"', '{column}'), coalesce(max("{column}"), 1), max("{column}") IS NOT NULL) FROM "{table}"''')
+        connection.commit()
+        elapsed = time.monotonic() - started
+        out(f'{kind}: {imported} records imported in {elapsed:.1f}s, {imported / max(elapsed, 1e-6):.0f} rows/sec')
+        return imported
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+def commit_chunk(cursor, connection, kind, columns, chunk, source, fingerprint, done, imported):
+    """Copy, merge and commit a chunk with its checkpoint, returns the new (done, imported) counts"""
+    cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS import_staging ({columns}, line bigserial) ON COMMIT DROP')
+    copy_chunk(cursor, kind, chunk)
+    cursor.execute(KINDS[kind]['merge'])
+    cursor.execute(BUMP_LIST_GENERATIONS, {'names': KINDS[kind]['lists']})
+    done += len(chunk)
+    cursor.execute('''INSERT INTO import_checkpoints (source, fingerprint, records, updated_at) VALUES (%s, %s, %s, now())
+        ON CONFLICT (source) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, records = EXCLUDED.records, updated_at = EXCLUDED.updated_at''',
+        (source, fingerprint, done))
+    connection.commit()
+    return done, imported + len(chunk)
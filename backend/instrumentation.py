@@ -0,0 +1,129 @@
+import logging
+import os
+import time
+from collections import Counter
+from flask import request, current_app, has_request_context, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+SQL instrumentation
+
+Opt-in with SQL_INSTRUMENTATION. Every statement of a request is recorded: the statements slower
+than SQL_SLOW_QUERY_MS are logged with their EXPLAIN plan, and once the response is built the
+request is checked against the query budget of its endpoint (the query_budget decorator) and
+for a statement run SQL_REPEAT_THRESHOLD times or more with different parameters, the sign of a
+lazy load per row (N+1). 'log' logs these problems, 'strict' raises QueryBudgetExceeded instead,
+which fails the request: the test suite runs in strict mode. The writes are checked by the commit
+hook of the application after their last flush and before their commit, so that a write failed
+in strict mode is rolled back. The statements of a streamed
+export, run after the response is built, are only logged. The statements executed with the
+sql_instrumentation=False execution option, such as the health checks of the read replicas,
+are left out.
+'''
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'off').lower()
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+
+logger = logging.getLogger(__name__)
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def query_budget(statements):
+    """Set the maximum number of statements a request of the endpoint may run
+    Keyword arguments:
+        statements -- the integer budget, with a cold read cache
+    """
+    def query_budget_decorator(f):
+        f.query_budget = statements
+        return f
+    return query_budget_decorator
+
+def explain(connection, statement, parameters):
+    """Get the plan of a statement, in a savepoint so that a failure leaves the transaction usable"""
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+        return 'no plan'
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT sql_explain')
+        try:
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT sql_explain')
+            plan = f'EXPLAIN failed: {e}'
+        cursor.execute('RELEASE SAVEPOINT sql_explain')
+        return plan
+    finally:
+        cursor.close()
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._sql_started = time.perf_counter()
+
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_sql_started', None)
+    if started is None or context.execution_options.get('sql_instrumentation') is False:
+        return
+    elapsed = (time.perf_counter() - started) * 1000
+    if has_request_context():
+        ctx = _request_ctx_stack.top
+        if not hasattr(ctx, 'sql_statements'):
+            ctx.sql_statements = []
+        ctx.sql_statements.append(statement)
+    if elapsed >= SQL_SLOW_QUERY_MS and not executemany:
+        logger.warning('slow statement, %.1f ms: %s\nparameters: %r\n%s', elapsed, statement, parameters, explain(conn, statement, parameters))
+
+def repeated_statements(statements):
+    """Get the (statement, count) of the statements run SQL_REPEAT_THRESHOLD times or more"""
+    return [(statement, count) for statement, count in Counter(statements).most_common() if count >= SQL_REPEAT_THRESHOLD]
+
+def request_problems(statements):
+    problems = []
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    if budget is not None and len(statements) > budget:
+        problems.append(f'{len(statements)} statements, over the budget of {budget}')
+    for statement, count in repeated_statements(statements):
+        problems.append(f'likely N+1, {count} times: {statement}')
+    return problems
+
+def check_request(response):
+    """Check the statements run to build the response once, an after_request hook also called
+    by the commit hook before the commit of a write
+    """
+    ctx = _request_ctx_stack.top
+    if SQL_INSTRUMENTATION not in ('log', 'strict') or hasattr(ctx, 'sql_checked'):
+        return response
+    statements = getattr(ctx, 'sql_statements', [])
+    ctx.sql_checked = len(statements)
+    problems = request_problems(statements)
+    if problems:
+        message = f'{request.method} {request.full_path.rstrip("?")}: ' + '; '.join(problems)
+        if SQL_INSTRUMENTATION == 'strict':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+def check_stream(error=None):
+    """Log the repeated statements of a streamed response, run after check_request"""
+    ctx = _request_ctx_stack.top
+    statements = getattr(ctx, 'sql_statements', [])
+    if len(statements) > getattr(ctx, 'sql_checked', len(statements)):
+        for statement, count in repeated_statements(statements[ctx.sql_checked:]):
+            logger.warning('%s %s streamed, likely N+1, %s times: %s', request.method, request.path, count, statement)
+
+def init_app(app):
+    """Instrument the statements of the requests of an application when SQL_INSTRUMENTATION is
+    log or strict, the commit hook of the application calls check_request before a commit
+    Keyword arguments:
+        app -- the flask application
+    """
+    if SQL_INSTRUMENTATION not in ('log', 'strict'):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', start_statement):
+        event.listen(Engine, 'before_cursor_execute', start_statement)
+        event.listen(Engine, 'after_cursor_execute', end_statement)
+    app.after_request(check_request)
+    app.teardown_request(check_stream)
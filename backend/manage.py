@@ -1,14 +1,49 @@
-from flask_script import Manager
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from flaskapp import app
+from flaskapp import create_app
 from models import db
+import importer
+import seeder
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+class ImportCommand(Command):
+    """Stream a CSV or NDJSON file of movies, actors, roles or castings into the database"""
+    option_list = (
+        Option('kind', choices=list(importer.KINDS)),
+        Option('path'),
+        Option('--format', dest='file_format', choices=['csv', 'ndjson'], default=None),
+        Option('--checkpoint', dest='checkpoint', type=int, default=importer.CHECKPOINT_ROWS),
+        Option('--restart', dest='restart', action='store_true', default=False),
+    )
+
+    def run(self, kind, path, file_format, checkpoint, restart):
+        importer.import_file(kind, path, file_format, checkpoint, restart)
+
+manager.add_command('import', ImportCommand())
+
+
+class SeedCommand(Command):
+    """Fill the database with a generated catalog of movies, actors, roles and castings"""
+    option_list = (
+        Option('--movies', dest='movies', type=int, default=10000),
+        Option('--actors', dest='actors', type=int, default=20000),
+        Option('--roles', dest='roles', type=int, default=10, help='mean number of roles per movie'),
+        Option('--seed', dest='seed', type=int, default=0),
+        Option('--truncate', dest='truncate', action='store_true', default=False),
+    )
+
+    def run(self, movies, actors, roles, seed, truncate):
+        seeder.seed_catalog(movies, actors, roles, seed, truncate)
+
+manager.add_command('seed', SeedCommand())
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
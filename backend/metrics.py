@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import request, current_app, has_request_context, _request_ctx_stack, Response as FlaskResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Metrics
+
+Every worker process counts its requests per route (the URL rule, e.g. /movies/<int:id>), method
+and status: latency histograms, requests in flight, database time and statements per request,
+response sizes, and the time requires_auth takes per outcome. GET /metrics renders them in the
+Prometheus text format; each worker reports its own counters, the scraper sums the workers.
+The recording costs two clock reads per statement and one lock per request.
+'''
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PREFIX = 'castingagency_'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+AUTH_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    """A metric family with a fixed list of label names
+    Keyword arguments:
+        name -- the String name, without the prefix
+        help -- the String description
+        labels -- the tuple of label names
+    """
+    kind = None
+    def __init__(self, name, help, labels=()):
+        self.name = METRICS_PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.extend(self.render_series(labels, value))
+        return lines
+    def render_series(self, labels, value):
+        return [f'{self.name}{render_labels(self.labels, labels)} {format_value(value)}']
+
+class Counter(Metric):
+    kind = 'counter'
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+    def add(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    def set(self, labels=(), value=0):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    """Histogram with fixed upper bounds, rendered as cumulative buckets, a sum and a count
+    Keyword arguments:
+        buckets -- the sorted tuple of the bucket upper bounds, +Inf is implicit
+    """
+    kind = 'histogram'
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    def render_series(self, labels, series):
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket
+            le = 'le="' + format_value(bound) + '"'
+            lines.append(f'{self.name}_bucket{render_labels(self.labels, labels, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{render_labels(self.labels, labels)} {format_value(total)}')
+        lines.append(f'{self.name}_count{render_labels(self.labels, labels)} {count}')
+        return lines
+
+class Registry(object):
+    """The metrics of the process"""
+    def __init__(self):
+        self.metrics = []
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+request_duration = registry.register(Histogram('request_duration_seconds', 'Time to build the response of a request, streamed bodies included', ('route', 'method', 'status')))
+requests_in_flight = registry.register(Gauge('requests_in_flight', 'Requests being processed', ('route',)))
+request_db_duration = registry.register(Histogram('request_db_duration_seconds', 'Time spent in database statements per request', ('route', 'method')))
+request_queries = registry.register(Histogram('request_queries', 'Database statements per request', ('route', 'method'), QUERY_BUCKETS))
+response_size = registry.register(Histogram('response_size_bytes', 'Size of the response bodies, as sent (compressed), streamed bodies excluded', ('route', 'method'), SIZE_BUCKETS))
+auth_duration = registry.register(Histogram('auth_duration_seconds', 'Time of requires_auth by outcome: cached, verified or rejected', ('outcome',), AUTH_BUCKETS))
+process_stats = registry.register(Gauge('stats', 'Numeric statistics of the process reported by GET /health, per source', ('source', 'stat')))
+
+def collect_stats(stats):
+    """Set process_stats from the numeric statistics of the health check
+    Keyword arguments:
+        stats -- the dict of dicts of statistics per source
+    """
+    for source, values in stats.items():
+        for stat, value in values.items():
+            if isinstance(value, (int, float)):
+                process_stats.set((source, stat), float(value))
+
+def observe_auth(seconds, outcome):
+    """Record the time requires_auth took to accept or reject a token"""
+    if METRICS_ENABLED:
+        auth_duration.observe((outcome,), seconds)
+
+def route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is None or not has_request_context():
+        return
+    ctx = _request_ctx_stack.top
+    ctx.metrics_db_seconds = getattr(ctx, 'metrics_db_seconds', 0.0) + time.perf_counter() - started
+    ctx.metrics_queries = getattr(ctx, 'metrics_queries', 0) + 1
+
+def start_request():
+    ctx = _request_ctx_stack.top
+    ctx.metrics_started = time.perf_counter()
+    ctx.metrics_route = route_label()
+    requests_in_flight.add((ctx.metrics_route,), 1)
+
+def finish_response(response):
+    """Record the status and size of the final response, the last after_request hook"""
+    ctx = _request_ctx_stack.top
+    ctx.metrics_status = response.status_code
+    if not response.is_streamed:
+        response_size.observe((getattr(ctx, 'metrics_route', route_label()), request.method), response.calculate_content_length() or 0)
+    return response
+
+def end_request(error=None):
+    """Record the duration of the request, once its response, streamed or not, is complete"""
+    ctx = _request_ctx_stack.top
+    started = getattr(ctx, 'metrics_started', None)
+    if started is None:
+        return
+    route, method = ctx.metrics_route, request.method
+    status = getattr(ctx, 'metrics_status', 500)
+    requests_in_flight.add((route,), -1)
+    request_duration.observe((route, method, str(status)), time.perf_counter() - started)
+    request_db_duration.observe((route, method), getattr(ctx, 'metrics_db_seconds', 0.0))
+    request_queries.observe((route, method), getattr(ctx, 'metrics_queries', 0))
+
+def render_metrics():
+    """The /metrics endpoint, a bearer METRICS_TOKEN is required when it is set"""
+    if METRICS_TOKEN and request.headers.get('Authorization', '') != f'Bearer {METRICS_TOKEN}':
+        return FlaskResponse('unauthorized\n', status=401, mimetype='text/plain')
+    read_stats = current_app.extensions.get('metrics_stats')
+    if read_stats is not None:
+        collect_stats(read_stats())
+    return FlaskResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def init_app(app, read_stats=None):
+    """Record the metrics of the requests of an application and serve them on /metrics, to call
+    before the other after_request hooks are registered so that it sees the final response
+    Keyword arguments:
+        app -- the flask application
+        read_stats -- the function returning the statistics of the health check, exported as gauges
+    """
+    if not METRICS_ENABLED:
+        return
+    app.extensions['metrics_stats'] = read_stats
+    app.before_request(start_request)
+    app.after_request(finish_response)
+    app.teardown_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', render_metrics, methods=['GET'])
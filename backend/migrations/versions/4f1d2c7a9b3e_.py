@@ -0,0 +1,30 @@
+"""sort key indexes for keyset pagination
+
+Revision ID: 4f1d2c7a9b3e
+Revises: 9c0b36e77224
+Create Date: 2026-10-18 09:12:41.305117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1d2c7a9b3e'
+down_revision = '9c0b36e77224'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_movies_name_id', 'Movies', ['name', 'id'], unique=False)
+    op.create_index('ix_movies_release_id', 'Movies', ['release', 'id'], unique=False)
+    op.create_index('ix_actors_name_id', 'Actors', ['name', 'id'], unique=False)
+    op.create_index('ix_actors_age_id', 'Actors', ['age', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_age_id', table_name='Actors')
+    op.drop_index('ix_actors_name_id', table_name='Actors')
+    op.drop_index('ix_movies_release_id', table_name='Movies')
+    op.drop_index('ix_movies_name_id', table_name='Movies')
@@ -0,0 +1,30 @@
+"""generations of the movie and actor lists for their ETags
+
+Revision ID: 7d3a9f21c6b8
+Revises: e5b71c3a2d48
+Create Date: 2026-10-18 18:05:47.120394
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3a9f21c6b8'
+down_revision = 'e5b71c3a2d48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('list_generations',
+    sa.Column('name', sa.String(length=20), nullable=False),
+    sa.Column('generation', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # the lists start from the time of the migration, a value no list ETag was built from
+    op.execute("INSERT INTO list_generations (name, generation) SELECT name, (extract(epoch FROM clock_timestamp()) * 1000000)::bigint FROM unnest(ARRAY['actors', 'movies']) AS name")
+
+
+def downgrade():
+    op.drop_table('list_generations')
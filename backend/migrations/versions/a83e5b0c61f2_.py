@@ -0,0 +1,54 @@
+"""full-text and trigram search indexes on names
+
+Revision ID: a83e5b0c61f2
+Revises: 4f1d2c7a9b3e
+Create Date: 2026-10-18 11:40:03.582216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83e5b0c61f2'
+down_revision = '4f1d2c7a9b3e'
+branch_labels = None
+depends_on = None
+
+
+def create_trigram_extension():
+    """Install pg_trgm when the server ships it and the role may create it.
+    The trigram indexes are not declared in models.py, search.py detects them at runtime.
+    """
+    connection = op.get_bind()
+    available = connection.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar()
+    if available is None:
+        return False
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(sa.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        savepoint.commit()
+        return True
+    except sa.exc.DBAPIError:
+        savepoint.rollback()
+        return False
+
+
+def upgrade():
+    for table in ['Movies', 'Actors']:
+        op.add_column(table, sa.Column('name_tsv', postgresql.TSVECTOR(), sa.Computed("to_tsvector('simple', name)", persisted=True), nullable=True))
+    op.create_index('ix_movies_name_tsv', 'Movies', ['name_tsv'], unique=False, postgresql_using='gin')
+    op.create_index('ix_actors_name_tsv', 'Actors', ['name_tsv'], unique=False, postgresql_using='gin')
+    if create_trigram_extension():
+        op.create_index('ix_movies_name_trgm', 'Movies', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+        op.create_index('ix_actors_name_trgm', 'Actors', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS "ix_actors_name_trgm"')
+    op.execute('DROP INDEX IF EXISTS "ix_movies_name_trgm"')
+    op.drop_index('ix_actors_name_tsv', table_name='Actors')
+    op.drop_index('ix_movies_name_tsv', table_name='Movies')
+    op.drop_column('Actors', 'name_tsv')
+    op.drop_column('Movies', 'name_tsv')
@@ -0,0 +1,26 @@
+"""composite index for the actor search filters
+
+Revision ID: c2d9e4f7a015
+Revises: a83e5b0c61f2
+Create Date: 2026-10-18 13:05:27.914430
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d9e4f7a015'
+down_revision = 'a83e5b0c61f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # gender equality or IN list with an age range, ordered by id;
+    # age only ranges use ix_actors_age_id from 4f1d2c7a9b3e
+    op.create_index('ix_actors_gender_age_id', 'Actors', ['gender', 'age', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age_id', table_name='Actors')
@@ -0,0 +1,34 @@
+"""version and updated_at of movies and actors for conditional requests
+
+Revision ID: e5b71c3a2d48
+Revises: c2d9e4f7a015
+Create Date: 2026-10-18 15:42:09.301877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b71c3a2d48'
+down_revision = 'c2d9e4f7a015'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows start at version 1, modified at the time of the migration
+    for table in ['Movies', 'Actors']:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), server_default=sa.text("timezone('utc', now())"), nullable=False))
+    # max(updated_at) of the list ETags and the since filter of the exports
+    op.create_index('ix_movies_updated_at', 'Movies', ['updated_at'], unique=False)
+    op.create_index('ix_actors_updated_at', 'Actors', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_updated_at', table_name='Actors')
+    op.drop_index('ix_movies_updated_at', table_name='Movies')
+    for table in ['Actors', 'Movies']:
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
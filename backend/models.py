@@ -1,36 +1,438 @@
 import os
 import json
 import sys
+import base64
+import binascii
+import hashlib
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, create_engine, tuple_, func, text, event, inspect, select
+from sqlalchemy.orm import joinedload, selectinload, Session
+from sqlalchemy.exc import IntegrityError, DataError, OperationalError, DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from search import SearchEngine, TEXT_SEARCH_CONFIG
+from cache import ReadCache, create_backend
+from pool import engine_options
+from replicas import RoutingSQLAlchemy, ReplicaSet, DATABASE_REPLICAS
+from graph import casting_graph, DatabaseGraph, GRAPH_MAX_DEPTH
+from responses import AppError
 
 
 database_path = os.environ.get('DATABASE_PATH') 
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+search_engine = SearchEngine(db)
 
 '''flask_sqlalchemy
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with its read replicas
 '''
-def setup_db(app, database=database_path):
+def setup_db(app, database=database_path, replicas=DATABASE_REPLICAS):
     app.config["SQLALCHEMY_DATABASE_URI"] = database
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # the pool settings of the environment, unless the application configures its own
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options())
+    previous = app.extensions.pop('replicas', None)
+    if previous is not None:
+        previous.dispose()
+    if replicas:
+        # the writers are shared by the workers when the read cache is
+        writers = read_cache.backend if read_cache.backend.name != 'local' else None
+        app.extensions['replicas'] = ReplicaSet(replicas, app.config["SQLALCHEMY_ENGINE_OPTIONS"], writers)
     db.app = app
     db.init_app(app)
     migrate = Migrate(app,db)
     return db
-    
+
+'''
+Unit of work
+
+A request runs in one transaction. The write methods of the models add and flush, the
+transaction is committed once for the whole request by the application (or by the caller
+outside of a request), and the read cache is invalidated after the commit only, with the
+tags the writes collected in the session. The generations of the lists tagged are bumped by
+the commit itself, in one statement. The casting changes are applied to the casting graph of
+the process after the commit.
+'''
+def invalidate_on_commit(*tags):
+    """Invalidate read cache tags once the current transaction commits
+    Keyword arguments:
+        tags -- the tags of the read cache changed by the transaction
+    """
+    db.session.info.setdefault('invalidate', set()).update(tags)
+
+def graph_on_commit(*changes):
+    """Apply casting changes to the casting graph once the current transaction commits
+    Keyword arguments:
+        changes -- the ('cast', actor id, movie id, roles added or removed), ('drop_actor', actor id)
+                   and ('drop_movie', movie id) of the transaction
+    """
+    if not changes:
+        return
+    if 'graph_txid' not in db.session.info and any(change[0] == 'cast' for change in changes):
+        # a read of the graph running at the commit tells by the transaction id whether it saw
+        # the castings, the drops can be applied twice
+        db.session.info['graph_txid'] = db.session.execute(text('SELECT txid_current()')).scalar()
+    db.session.info.setdefault('graph', []).extend(changes)
+
+@event.listens_for(Session, 'before_commit')
+def bump_committed_lists(session):
+    # the pending changes first, so that the generations are the last rows locked
+    session.flush()
+    names = sorted(tag for tag in session.info.get('invalidate', ()) if tag in LIST_TAGS)
+    if names:
+        session.connection().execute(BUMP_LIST_GENERATIONS, {'names': names})
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    tags = session.info.pop('invalidate', None)
+    if tags:
+        read_cache.invalidate(*tags)
+    txid = session.info.pop('graph_txid', None)
+    changes = session.info.pop('graph', None)
+    if changes:
+        casting_graph.apply(changes, txid)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_invalidations(session):
+    session.info.pop('invalidate', None)
+    session.info.pop('graph', None)
+    session.info.pop('graph_txid', None)
+
+def casting_graph_of_request():
+    """Get the casting graph of the process, or the SQL queries of the session while it is read"""
+    return casting_graph.current(db.engine) or DatabaseGraph(db.session)
+
+def database_error(error):
+    """Roll back the transaction of a failed database operation and get the AppError to respond
+    Keyword arguments:
+        error -- the SQLAlchemyError raised
+    """
+    db.session.rollback()
+    if isinstance(error, IntegrityError):
+        return AppError(title='Conflict', detail='The request conflicts with the stored data', status_code=409)
+    if isinstance(error, DataError):
+        return AppError(title='Wrong Request', detail='A value is not valid for the stored data', status_code=422)
+    if isinstance(error, (OperationalError, DisconnectionError, PoolTimeoutError)):
+        return AppError(title='Service Unavailable', detail='The database is not available, retry later', status_code=503)
+    return AppError(title='Internal Server Error', detail='Internal problem while processing the request', status_code=500)
+
 
 '''
 Configuration
 
 '''
-MAX_MOVIES_PER_PAGE = 10
-MAX_ACTORS_PER_PAGE = 10
+MOVIES_PER_PAGE = int(os.environ.get('MOVIES_PER_PAGE', 10))
+ACTORS_PER_PAGE = int(os.environ.get('ACTORS_PER_PAGE', 10))
+MAX_PER_PAGE = int(os.environ.get('MAX_PER_PAGE', 100))
+MAX_UNPAGED_ITEMS = int(os.environ.get('MAX_UNPAGED_ITEMS', 1000))
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+
+'''
+Pagination
+
+'''
+def page_size(per_page, default):
+    """Get the page size requested, bounded by MAX_PER_PAGE
+    Keyword arguments:
+        per_page -- the integer page size requested, None for the default
+        default -- the integer default page size of the model
+    """
+    if per_page is None or per_page <= 0:
+        return default
+    return min(per_page, MAX_PER_PAGE)
+
+def paginate(query, order_by, page, per_page):
+    """Run a page of the query in the database, with a separate count
+    Keyword arguments:
+        query -- the model query to paginate
+        order_by -- the columns giving a deterministic order
+        page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS rows
+        per_page -- the integer page size
+    Returns (items, total), or None when the page is out of range
+    """
+    total = query.order_by(None).count()
+    query = query.order_by(*order_by)
+    if page <= 0:
+        return query.limit(MAX_UNPAGED_ITEMS).all(), total
+    offset = (page-1)*per_page
+    if offset > total:
+        return None
+    return query.offset(offset).limit(per_page).all(), total
+
+'''
+Keyset pagination
+
+'''
+def encode_cursor(sort, direction, values):
+    """Build the opaque cursor for the sort key values of a row
+    Keyword arguments:
+        sort -- the String name of the sort key
+        direction -- 'next' or 'prev'
+        values -- the values of the sort key columns of the row
+    """
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    data = json.dumps({'s': sort, 'd': direction, 'k': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort, columns):
+    """Read an opaque cursor, raises ValueError when it is not valid for the sort key
+    Keyword arguments:
+        cursor -- the String cursor sent by the client
+        sort -- the String name of the sort key requested
+        columns -- the columns of the sort key
+    Returns (direction, values)
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        direction, values = data['d'], data['k']
+        matches = data.get('s') == sort and direction in ('next', 'prev') and isinstance(values, list) and len(values) == len(columns)
+        if matches:
+            values = [cursor_value(column, value) for column, value in zip(columns, values)]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError('cursor not valid')
+    if not matches:
+        raise ValueError('cursor not valid for the sort requested')
+    return direction, values
+
+def cursor_value(column, value):
+    """Read the value of a sort key column from a cursor, raises TypeError or ValueError when it
+    does not have the type of the column
+    """
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        raise TypeError(f'{column.key} must be a {python_type.__name__}')
+    return value
+
+def keyset_page(query, sort, columns, cursor, per_page):
+    """Run a page of the query after (or before) the row encoded in the cursor, using a range scan
+    on the sort key index instead of an OFFSET
+    Keyword arguments:
+        query -- the model query to paginate
+        sort -- the String name of the sort key
+        columns -- the sort key columns, ending with the primary key
+        cursor -- the String cursor, empty for the first page
+        per_page -- the integer page size
+    Returns (items, next_cursor, prev_cursor)
+    """
+    key = tuple_(*columns) if len(columns) > 1 else columns[0]
+    direction, values = decode_cursor(cursor, sort, columns) if cursor else ('next', None)
+    if direction == 'next':
+        if values is not None:
+            query = query.filter(key > (tuple_(*values) if len(columns) > 1 else values[0]))
+        query = query.order_by(*columns)
+    else:
+        query = query.filter(key < (tuple_(*values) if len(columns) > 1 else values[0]))
+        query = query.order_by(*[column.desc() for column in columns])
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    row_key = lambda item: [getattr(item, column.key) for column in columns]
+    next_cursor, prev_cursor = None, None
+    if items and (has_more or direction == 'prev'):
+        next_cursor = encode_cursor(sort, 'next', row_key(items[-1]))
+    if items and (values is not None) and (has_more or direction == 'next'):
+        prev_cursor = encode_cursor(sort, 'prev', row_key(items[0]))
+    return items, next_cursor, prev_cursor
+
+'''
+Export
+
+'''
+def export_rows(query, model, after_id=None, until_id=None, since=None):
+    """Iterate over the rows of a query in id order, fetched EXPORT_BATCH_SIZE at a time
+    from a server-side cursor
+    Keyword arguments:
+        query -- the model query to export
+        model -- the model class, with id and updated_at columns
+        after_id -- only the rows with a greater id
+        until_id -- only the rows with a lower or equal id
+        since -- only the rows modified at or after this UTC datetime
+    """
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    if until_id is not None:
+        query = query.filter(model.id <= until_id)
+    if since is not None:
+        query = query.filter(model.updated_at >= since)
+    query = query.order_by(model.id).execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+    for row in query:
+        yield row
+
+'''
+Bulk insert
+
+'''
+def bulk_insert(table, rows):
+    """Insert rows with multi-row INSERT statements of BULK_BATCH_SIZE rows, in the current
+    transaction. The ids are drawn from the sequence of the table first and given to the rows in
+    order, as Postgres does not return the rows of an INSERT in the order of its VALUES.
+    Keyword arguments:
+        table -- the model table
+        rows -- the list of column dicts
+    Returns the list of ids in the order of the rows
+    """
+    if not rows:
+        return []
+    sequence = func.pg_get_serial_sequence(f'"{table.name}"', 'id')
+    result = db.session.execute(select([func.nextval(sequence)]).select_from(func.generate_series(1, len(rows))))
+    ids = [row[0] for row in result]
+    rows = [dict(row, id=row_id) for row, row_id in zip(rows, ids)]
+    for start in range(0, len(rows), BULK_BATCH_SIZE):
+        db.session.execute(table.insert().values(rows[start:start+BULK_BATCH_SIZE]))
+    return ids
+
+def bulk_create(table, items, validate):
+    """Validate all the items in one pass, then insert the valid ones in a single transaction
+    Keyword arguments:
+        table -- the model table
+        items -- the list of items of the request body
+        validate -- the function returning (row, error) for an item
+    Returns the list of results per item, the rows are committed with the request
+    """
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        row, error = validate(item)
+        if error is not None:
+            results.append({'index': index, 'error': error})
+        else:
+            results.append({'index': index, 'id': None})
+            rows.append(row)
+    ids = iter(bulk_insert(table, rows))
+    invalidate_on_commit(table.name.lower())
+    for result in results:
+        if 'id' in result:
+            result['id'] = next(ids)
+    return results
+
+'''
+Conditional requests
+
+Movies and Actors carry a version, bumped by each update, and the UTC time of their last change.
+A change to the cast of a movie (its roles, their actors, or the actors themselves) touches the
+movie too, as the roles and their actors are part of its representation.
+The lists of movies and actors carry a generation in list_generations, bumped by the commit of
+every write to the list: the unit of work for the API, the import and the seed in their own
+transactions. The row is locked from the bump to the end of the commit only, after every other
+lock of the transaction. A new generation starts from the time in microseconds, a value no
+previous list had.
+'''
+UTC_NOW = text("timezone('utc', now())")
+
+list_generations = db.Table('list_generations',
+    db.Column('name', db.String(20), primary_key=True),
+    db.Column('generation', db.BigInteger, nullable=False),
+)
+
+LIST_TAGS = ('actors', 'movies')
+
+# the rows are locked in name order, by the API, the import and the seed alike
+BUMP_LIST_GENERATIONS = '''INSERT INTO list_generations (name, generation)
+    SELECT name, (extract(epoch FROM clock_timestamp()) * 1000000)::bigint FROM unnest(%(names)s::varchar[]) AS name ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET generation = list_generations.generation + 1'''
+
+def touch_movies(movie_ids):
+    """Bump the version of movies whose cast changed, in the current transaction
+    Keyword arguments:
+        movie_ids -- the list of movie ids
+    """
+    if not movie_ids:
+        return
+    db.session.query(Movies).filter(Movies.id.in_(movie_ids))\
+        .update({Movies.version: Movies.version + 1, Movies.updated_at: datetime.utcnow()}, synchronize_session=False)
+
+def cast_movie_ids(actor_id):
+    """Get the ids of the movies an actor is cast in
+    Keyword arguments:
+        actor_id -- the integer id of the actor
+    """
+    rows = db.session.query(movies_roles_items.c.movie_id)\
+        .join(roles_actors_items, roles_actors_items.c.role_id == movies_roles_items.c.role_id)\
+        .filter(roles_actors_items.c.actor_id == actor_id)\
+        .distinct()
+    return [row[0] for row in rows]
+
+def movie_tags(movie_ids):
+    """Get the read cache tags of movies and of the movie lists"""
+    return ['movies'] + [('movie', movie_id) for movie_id in movie_ids]
+
+def item_validators(model, id, *params):
+    """Get the (etag, last_modified) of an item without loading it, None when it does not exist
+    Keyword arguments:
+        model -- the model class
+        id -- the integer id of the item
+        params -- the request parameters selecting a representation of the item
+    """
+    row = db.session.query(model.version, model.updated_at).filter(model.id == id).first()
+    if row is None:
+        return None
+    etag = item_etag(model, id, row.version)
+    if params:
+        etag += '-' + hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:16]
+    return etag, row.updated_at
+
+def list_validators(model, *params):
+    """Get the (etag, last_modified) of a list of items from the generation of the list, a
+    single row read by its key whatever the size of the table
+    Keyword arguments:
+        model -- the model class
+        params -- the request parameters selecting the list
+    Last-Modified is None, as a delete leaves no modification time behind
+    """
+    name = model.__tablename__.lower()
+    generation = db.session.query(list_generations.c.generation).filter(list_generations.c.name == name).scalar()
+    state = repr((model.__tablename__, generation, params))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest(), None
+
+def page_validators(model, items, *params):
+    """Get the (etag, last_modified) of a keyset page from the rows it was built from, without
+    a query: the versions of its items and the cursors to its neighbours
+    Keyword arguments:
+        model -- the model class
+        items -- the model instances of the page
+        params -- the request parameters and the cursors of the page
+    """
+    state = repr((model.__tablename__, [(item.id, item.version) for item in items], params))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest(), None
+
+'''
+Read cache
+
+The lists are cached as pages of (id, ETag) entries, and every item on its own: a page needs
+one lookup for its entry and one multi-get for its items, and only the items missing are read
+from the database. The items are shared by every page, and by the single item reads.
+'''
+read_cache = ReadCache(create_backend())
+
+def item_etag(model, id, version):
+    return f'{model.__tablename__.lower()}-{id}-{version}'
+
+def cached_items(model, tag, page, load_items):
+    """Get the formatted items of a cached page, with one multi-get
+    Keyword arguments:
+        model -- the model class of the items
+        tag -- the String tag of an item, 'movie' or 'actor'
+        page -- the list of (id, etag) of the items
+        load_items -- the function reading the model instances for a list of ids
+    """
+    entries = [((tag, id), [(tag, id)], etag) for id, etag in page]
+    found, generations = read_cache.get_many(entries)
+    missing = [id for id, _ in page if (tag, id) not in found]
+    if missing:
+        loaded = [((tag, item.id), [(tag, item.id)], item_etag(model, item.id, item.version), item.format()) for item in load_items(missing)]
+        read_cache.set_many(loaded, generations)
+        found.update({key: value for key, _, _, value in loaded})
+    # an item deleted after the page was read is left out
+    return [found[(tag, id)] for id, _ in page if (tag, id) in found]
 
 '''
 Models
@@ -55,7 +457,16 @@ class Movies(db.Model):
     photoUrl = db.Column(db.String(), nullable=True,default="")
     release = db.Column(db.DateTime,nullable=False)
     genres =  db.Column(db.ARRAY(db.String()),nullable=False,server_default="{}") 
-    roles = db.relationship('Roles', secondary=movies_roles_items,lazy='subquery',backref=db.backref('movie', lazy=True))
+    name_tsv = db.Column(TSVECTOR, db.Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', name)", persisted=True))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=UTC_NOW)
+    roles = db.relationship('Roles', secondary=movies_roles_items,lazy='select',backref=db.backref('movie', lazy=True))
+    __table_args__ = (
+        db.Index('ix_movies_name_id', 'name', 'id'),
+        db.Index('ix_movies_release_id', 'release', 'id'),
+        db.Index('ix_movies_name_tsv', 'name_tsv', postgresql_using='gin'),
+        db.Index('ix_movies_updated_at', 'updated_at'),
+    )
     
     def __init__(self,name, photo, release, genres):
         self.name = name
@@ -63,37 +474,23 @@ class Movies(db.Model):
         self.release = release
         self.genres = genres
     def insert(self):
-        responseStruct = None
-        try:
-            db.session.add(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()
-        finally:
-            db.session.close()
-        return responseStruct
+        db.session.add(self)
+        # the id of the response
+        db.session.flush()
+        invalidate_on_commit('movies')
+        return self.response()
     def update(self):
-        responseStruct = None
-        try:
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct  
+        self.version = Movies.version + 1
+        db.session.flush()
+        invalidate_on_commit(*movie_tags([self.id]))
+        return self.response()
     def delete(self):
-        responseStruct = None
-        try:        
-            db.session.delete(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct            
+        responseStruct = self.response()
+        db.session.delete(self)
+        db.session.flush()
+        invalidate_on_commit(*movie_tags([responseStruct['id']]))
+        graph_on_commit(('drop_movie', responseStruct['id']))
+        return responseStruct
     def format(self):
         return {
             'name': self.name,
@@ -110,65 +507,201 @@ class Movies(db.Model):
     def __repr__(self):
         return f'{self.format()}'
     @staticmethod
-    def search(searchTerm):
-        """Get the entire movies list for a certain search word
+    def validate(item):
+        """Check a movie of a bulk request, returns (row, error)
+        Keyword arguments:
+            item -- the dict with name, genres, timestamp and optional photourl
+        """
+        if not isinstance(item, dict):
+            return None, 'Item must be an object'
+        name = item.get('name',None)
+        genres = item.get('genres',None)
+        timestamp = item.get('timestamp',None)
+        photoUrl = item.get('photourl',"")
+        if name is None or genres is None or timestamp is None:
+            return None, 'Name, Genres or Timestamp is missing'
+        if not isinstance(name, str) or len(name) == 0 or len(name) > 150:
+            return None, 'Name must be a String of 1 to 150 Characters'
+        if not isinstance(genres, list) or not all(isinstance(genre, str) for genre in genres):
+            return None, 'Genres must be an array of Strings'
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            return None, 'Timestamp must be a number'
+        if not isinstance(photoUrl, str):
+            return None, 'photoUrl must be a String'
+        try:
+            release = datetime.fromtimestamp(timestamp)
+        except (OverflowError, OSError, ValueError):
+            return None, 'Timestamp out of range'
+        return {'name': name, 'photoUrl': photoUrl, 'release': release, 'genres': genres}, None
+    @staticmethod
+    def bulk_create(items):
+        """Create movies in a single transaction
+        Keyword arguments:
+            items -- the list of movie dicts of the request
+        """
+        return bulk_create(Movies.__table__, items, Movies.validate)
+    @staticmethod
+    def list_query():
+        """Query for lists of movies: the roles and their actors are loaded with
+        one batched IN query each, whatever the number of movies in the page
+        """
+        return Movies.query.options(selectinload(Movies.roles).selectinload(Roles.actors))
+    @staticmethod
+    def item_query():
+        """Query for a single movie: the roles and their actors are joined in the same query
+        """
+        return Movies.query.options(joinedload(Movies.roles).joinedload(Roles.actors))
+    @staticmethod
+    def search(searchTerm, page=0, per_page=None):
+        """Get the movies matching a certain search word, most relevant first
         Keyword arguments:
             searchTerm -- the String term to search in the name of the movies
+            page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS movies
+            per_page -- the integer page size, MOVIES_PER_PAGE by default
         """
-        search = f'%{searchTerm}%'
-        #query the movie with WHERE LIKE case insentive
-        movies = Movies.query.filter(Movies.name.ilike(search)).all()
-        if len(movies) == 0:
-            return {'movies':[]}
-        return { 'movies': [movie.format() for movie in movies] }
+        clause, rank = search_engine.match(Movies.name, Movies.name_tsv, searchTerm)
+        result = paginate(Movies.list_query().filter(clause), [rank.desc(), Movies.id], page, page_size(per_page, MOVIES_PER_PAGE))
+        if result is None:
+            return None
+        movies, total = result
+        return { 'movies': [movie.format() for movie in movies], 'total': total, 'count': len(movies)}
     @staticmethod
     def get(id):
-        """Get the movie for an id
+        """Get the movie for an id, with its roles and their actors for the response of the writes
         Keyword arguments:
             id -- the integer id of the movie
         """
-        return Movies.query.get(id)
+        return Movies.item_query().filter(Movies.id == id).one_or_none()
+    @staticmethod
+    def validators(id, *params):
+        """Get the (etag, last_modified) of the movie for an id, None if it does not exist
+        Keyword arguments:
+            id -- the integer id of the movie
+            params -- the request parameters selecting a representation of the movie
+        """
+        return item_validators(Movies, id, *params)
+    @staticmethod
+    def list_validators(*params):
+        """Get the (etag, last_modified) of a list of movies
+        Keyword arguments:
+            params -- the request parameters selecting the list
+        """
+        return list_validators(Movies, *params)
     @staticmethod
-    def read(id):
+    def read(id, version=None):
         """Get the movie for an id
         Keyword arguments:
             id -- the integer id of the movie
+            version -- the current ETag of the movie, a cached movie of another version is reloaded
         """
-        movie = Movies.query.get(id)
+        def load():
+            movie = Movies.item_query().get(id)
+            if movie is None:
+                return None
+            return movie.format()
+        movie = read_cache.cached(('movie', id), [('movie', id)], load, version)
         if movie is None:
             return None
-        return movie.response()
+        return {'movie': movie, 'id': id}
     @staticmethod
-    def read_all(page=0):
+    def read_all(page=0, per_page=None, version=None):
         """Get all movies per page
         Keyword arguments:
             page -- the integer page number
+            per_page -- the integer page size, MOVIES_PER_PAGE by default
+            version -- the current ETag of the list, a cached page of another version is reloaded
         """
-        movies = Movies.query.all()
-        total = len(movies)
-
-        if page <= 0:
-            return { 'movies': [movie.format() for movie in movies], 'total': total, 'count': total}
-        offset = (page-1)*MAX_MOVIES_PER_PAGE
-        if offset > total:
+        per_page = page_size(per_page, MOVIES_PER_PAGE)
+        def load():
+            result = paginate(db.session.query(Movies.id, Movies.version), [Movies.id], page, per_page)
+            if result is None:
+                return None
+            rows, total = result
+            return {'items': [[id, item_etag(Movies, id, row_version)] for id, row_version in rows], 'total': total}
+        result = read_cache.cached(('movies', page, per_page), ['movies'], load, version)
+        if result is None:
             return None
-        limit = min(offset + MAX_MOVIES_PER_PAGE,total)
-        return { 'movies': [movie.format() for movie in movies][offset:limit], 'total': total, 'count':limit-offset}
+        movies = cached_items(Movies, 'movie', result['items'], lambda ids: Movies.list_query().filter(Movies.id.in_(ids)).all())
+        return { 'movies': movies, 'total': result['total'], 'count': len(movies)}
+    @staticmethod
+    def export(after_id=None, until_id=None, since=None):
+        """Iterate over all the movies in id order, for the streaming export
+        Keyword arguments:
+            after_id -- only the movies with a greater id
+            until_id -- only the movies with a lower or equal id
+            since -- only the movies modified at or after this UTC datetime
+        """
+        for movie in export_rows(Movies.list_query(), Movies, after_id, until_id, since):
+            yield movie.response()
     @staticmethod
-    def read_artists(id):
-        """Get overall artist casting for a movie
+    def sort_keys():
+        return {
+            'id': [Movies.id],
+            'name': [Movies.name, Movies.id],
+            'release': [Movies.release, Movies.id]
+        }
+    @staticmethod
+    def read_page(cursor, sort='id', per_page=None, *params):
+        """Get the movies after the cursor, keyset pagination, with the validators of the page
+        Keyword arguments:
+            cursor -- the String cursor of the previous response, empty for the first page
+            sort -- the String sort key: id, name or release
+            per_page -- the integer page size, MOVIES_PER_PAGE by default
+            params -- the request parameters selecting the page
+        Returns (responseStruct, validators)
+        """
+        columns = Movies.sort_keys().get(sort)
+        if columns is None:
+            raise ValueError('sort not valid')
+        movies, next_cursor, prev_cursor = keyset_page(Movies.list_query(), sort, columns, cursor, page_size(per_page, MOVIES_PER_PAGE))
+        validators = page_validators(Movies, movies, next_cursor, prev_cursor, *params)
+        return { 'movies': [movie.format() for movie in movies], 'count': len(movies), 'next': next_cursor, 'prev': prev_cursor}, validators
+    @staticmethod
+    def read_artists(id, page=0, per_page=None, sort='id', descending=False, version=None):
+        """Get overall artist casting for a movie, with one DISTINCT join over the casting tables
         Keyword arguments:
             id -- the integer id of the movie
+            page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS actors
+            per_page -- the integer page size, ACTORS_PER_PAGE by default
+            sort -- the String sort key: id, name or age
+            descending -- True to reverse the sort order
+            version -- the current ETag of the cast list, a cached list of another version is reloaded
         """
-        movie = Movies.query.get(id)
-        if movie is None:
+        if sort not in Actors.sort_keys():
+            raise ValueError('sort not valid')
+        per_page = page_size(per_page, ACTORS_PER_PAGE)
+        key = ('cast', id, page, per_page, sort, descending)
+        result = read_cache.cached(key, [('movie', id)], lambda: Movies._read_artists(id, page, per_page, sort, descending), version)
+        if result is None:
             return None
-        actors = []
-        for role in movie.roles:
-            for actor in role.actors:
-                if actor not in actors:
-                    actors.append(actor)
-        return { 'actors': [actor.format() for actor in actors]}
+        actors = cached_items(Actors, 'actor', result['items'], lambda ids: Actors.query.filter(Actors.id.in_(ids)).all())
+        return { 'actors': actors, 'total': result['total'], 'count': len(actors)}
+    @staticmethod
+    def _read_artists(id, page, per_page, sort, descending):
+        """Read the (id, etag) of the cast of a movie from the database, see read_artists"""
+        columns = Actors.sort_keys().get(sort)
+        if descending:
+            columns = [column.desc() for column in columns]
+        cast = db.session.query(roles_actors_items.c.actor_id)\
+            .join(movies_roles_items, movies_roles_items.c.role_id == roles_actors_items.c.role_id)\
+            .filter(movies_roles_items.c.movie_id == id)\
+            .distinct()\
+            .subquery()
+        query = db.session.query(Actors.id, Actors.version, func.count().over())\
+            .join(cast, cast.c.actor_id == Actors.id)\
+            .order_by(*columns)
+        if page <= 0:
+            query = query.limit(MAX_UNPAGED_ITEMS)
+        else:
+            query = query.offset((page-1)*per_page).limit(per_page)
+        rows = query.all()
+        if len(rows) == 0:
+            # an empty page is either an unknown movie or a page past the end of the cast
+            if db.session.query(Movies.id).filter(Movies.id == id).scalar() is None:
+                return None
+            total = db.session.query(func.count()).select_from(cast).scalar()
+            return {'items': [], 'total': total}
+        return {'items': [[actor_id, item_etag(Actors, actor_id, actor_version)] for actor_id, actor_version, _ in rows], 'total': rows[0][2]}
 
 class Actors(db.Model):
     __tablename__ = 'Actors'
@@ -177,6 +710,16 @@ class Actors(db.Model):
     photoUrl = db.Column(db.String(), nullable=True,default="")
     gender = db.Column(db.String(),nullable=False)
     age =  db.Column(db.Integer,nullable=False)
+    name_tsv = db.Column(TSVECTOR, db.Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', name)", persisted=True))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=UTC_NOW)
+    __table_args__ = (
+        db.Index('ix_actors_name_id', 'name', 'id'),
+        db.Index('ix_actors_age_id', 'age', 'id'),
+        db.Index('ix_actors_gender_age_id', 'gender', 'age', 'id'),
+        db.Index('ix_actors_name_tsv', 'name_tsv', postgresql_using='gin'),
+        db.Index('ix_actors_updated_at', 'updated_at'),
+    )
     
     def __init__(self,name, photo, gender, age):
         self.name = name
@@ -184,37 +727,26 @@ class Actors(db.Model):
         self.gender = gender
         self.age = age
     def insert(self):
-        responseStruct = None
-        try:
-            db.session.add(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()
-        finally:
-            db.session.close()
-        return responseStruct
+        db.session.add(self)
+        # the id of the response
+        db.session.flush()
+        invalidate_on_commit('actors')
+        return self.response()
     def update(self):
-        responseStruct = None
-        try:
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct  
+        self.version = Actors.version + 1
+        movie_ids = cast_movie_ids(self.id)
+        touch_movies(movie_ids)
+        invalidate_on_commit(('actor', self.id), 'actors', *movie_tags(movie_ids))
+        return self.response()
     def delete(self):
-        responseStruct = None
-        try:        
-            db.session.delete(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct            
+        responseStruct = self.response()
+        movie_ids = cast_movie_ids(self.id)
+        touch_movies(movie_ids)
+        db.session.delete(self)
+        db.session.flush()
+        invalidate_on_commit(('actor', responseStruct['id']), 'actors', *movie_tags(movie_ids))
+        graph_on_commit(('drop_actor', responseStruct['id']))
+        return responseStruct
     def format(self):
         return {
             'name': self.name,
@@ -230,67 +762,281 @@ class Actors(db.Model):
     def __repr__(self):
         return f'{self.format()}'
     @staticmethod
-    def search(searchName=None,searchGender=None,searchAge=None):
-        """Get the entire actor list for a given combination of search terms
+    def validate(item):
+        """Check an actor of a bulk request, returns (row, error)
+        Keyword arguments:
+            item -- the dict with name, gender, age and optional photourl
+        """
+        if not isinstance(item, dict):
+            return None, 'Item must be an object'
+        name = item.get('name',None)
+        gender = item.get('gender',None)
+        age = item.get('age',None)
+        photoUrl = item.get('photourl',"")
+        if name is None or gender is None or age is None:
+            return None, 'Name, Gender or Age is missing'
+        if not isinstance(name, str) or len(name) == 0 or len(name) > 150:
+            return None, 'Name must be a String of 1 to 150 Characters'
+        if not isinstance(gender, str):
+            return None, 'Gender must be a String'
+        if isinstance(age, bool) or not isinstance(age, int) or age < 0:
+            return None, 'Age must be a positive Integer'
+        if not isinstance(photoUrl, str):
+            return None, 'photoUrl must be a String'
+        return {'name': name, 'photoUrl': photoUrl, 'gender': gender, 'age': age}, None
+    @staticmethod
+    def bulk_create(items):
+        """Create actors in a single transaction
+        Keyword arguments:
+            items -- the list of actor dicts of the request
+        """
+        return bulk_create(Actors.__table__, items, Actors.validate)
+    @staticmethod
+    def search_query(searchName=None,searchGender=None,searchAge=None,searchAgeMin=None,searchAgeMax=None,sort=None,descending=False):
+        """Build the actor search query, returns (query, order_by)
         Keyword arguments:
             searchName -- the String term to search in the name of the actors
-            searchGender -- the String term to search in the gender of the actors
+            searchGender -- the String gender, or a list of genders, of the actors
             searchAge -- the Integer value to search in the age of the actors
+            searchAgeMin -- the Integer minimum age, inclusive
+            searchAgeMax -- the Integer maximum age, inclusive
+            sort -- the String sort key: id, name or age, by relevance when searching a name
+            descending -- True to reverse the sort order
         """
-        if searchName is None and searchGender is None and searchAge is None:
-            return {'actors':[]}
         query_search = Actors.query
+        order_by = [Actors.id]
         if searchName is not None:
-            search = f'%{searchName}%'
-            query_search = query_search.filter(Actors.name.ilike(search))
-        if searchGender is not None:
+            clause, rank = search_engine.match(Actors.name, Actors.name_tsv, searchName)
+            query_search = query_search.filter(clause)
+            order_by = [rank.desc(), Actors.id]
+        if sort is not None:
+            order_by = Actors.sort_keys().get(sort)
+            if order_by is None:
+                raise ValueError('sort not valid')
+            if descending:
+                order_by = [column.desc() for column in order_by]
+        if isinstance(searchGender, (list, tuple)):
+            query_search = query_search.filter(Actors.gender.in_(searchGender))
+        elif searchGender is not None:
             query_search = query_search.filter(Actors.gender == searchGender)
         if searchAge is not None:
             query_search = query_search.filter(Actors.age == searchAge)
-        actors = query_search.all()
-        if len(actors) == 0:
-            return {'actors':[]} 
-        return {'actors': [actor.format() for actor in actors]}
+        if searchAgeMin is not None:
+            query_search = query_search.filter(Actors.age >= searchAgeMin)
+        if searchAgeMax is not None:
+            query_search = query_search.filter(Actors.age <= searchAgeMax)
+        return query_search, order_by
+    @staticmethod
+    def search(searchName=None,searchGender=None,searchAge=None,searchAgeMin=None,searchAgeMax=None,sort=None,descending=False,page=0,per_page=None):
+        """Get the entire actor list for a given combination of search terms
+        Keyword arguments:
+            searchName -- the String term to search in the name of the actors
+            searchGender -- the String gender, or a list of genders, of the actors
+            searchAge -- the Integer value to search in the age of the actors
+            searchAgeMin -- the Integer minimum age, inclusive
+            searchAgeMax -- the Integer maximum age, inclusive
+            sort -- the String sort key: id, name or age, by relevance when searching a name
+            descending -- True to reverse the sort order
+            page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS actors
+            per_page -- the integer page size, ACTORS_PER_PAGE by default
+        """
+        if searchName is None and searchGender is None and searchAge is None and searchAgeMin is None and searchAgeMax is None:
+            return {'actors':[]}
+        query_search, order_by = Actors.search_query(searchName, searchGender, searchAge, searchAgeMin, searchAgeMax, sort, descending)
+        result = paginate(query_search, order_by, page, page_size(per_page, ACTORS_PER_PAGE))
+        if result is None:
+            return None
+        actors, total = result
+        return {'actors': [actor.format() for actor in actors], 'total': total, 'count': len(actors)}
     @staticmethod
     def get(id):
         """Get the actor for an id
         Keyword arguments:
             id -- the integer id of the actor
         """
-        return Actors.query.get(id)    
+        return Actors.query.get(id)
+    @staticmethod
+    def validators(id, *params):
+        """Get the (etag, last_modified) of the actor for an id, None if it does not exist
+        Keyword arguments:
+            id -- the integer id of the actor
+            params -- the request parameters selecting a representation of the actor
+        """
+        return item_validators(Actors, id, *params)
+    @staticmethod
+    def list_validators(*params):
+        """Get the (etag, last_modified) of a list of actors
+        Keyword arguments:
+            params -- the request parameters selecting the list
+        """
+        return list_validators(Actors, *params)    
+    @staticmethod
+    def read_movies(id, page=0, per_page=None):
+        """Get the movies an actor is cast in, from the casting graph, the latest release first,
+        with the roles of the actor in each
+        Keyword arguments:
+            id -- the integer id of the actor
+            page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS movies
+            per_page -- the integer page size, MOVIES_PER_PAGE by default
+        Returns None when the actor does not exist or the page is out of range
+        """
+        if db.session.query(Actors.id).filter(Actors.id == id).scalar() is None:
+            return None
+        movie_ids = list(casting_graph_of_request().movies_of(id))
+        per_page = page_size(per_page, MOVIES_PER_PAGE)
+        query = db.session.query(Movies.id, Movies.name, Movies.photoUrl, Movies.release, Movies.genres)\
+            .filter(Movies.id.in_(movie_ids))\
+            .order_by(Movies.release.desc(), Movies.id)
+        if page <= 0:
+            query = query.limit(MAX_UNPAGED_ITEMS)
+        elif (page-1)*per_page > len(movie_ids):
+            return None
+        else:
+            query = query.offset((page-1)*per_page).limit(per_page)
+        rows = query.all() if movie_ids else []
+        roles = {}
+        if rows:
+            cast = db.session.query(Roles.id, Roles.name, Roles.types, Roles.movie_id)\
+                .join(roles_actors_items, roles_actors_items.c.role_id == Roles.id)\
+                .filter(roles_actors_items.c.actor_id == id, Roles.movie_id.in_([row.id for row in rows]))\
+                .order_by(Roles.id)
+            for role_id, name, types, movie_id in cast:
+                roles.setdefault(movie_id, []).append({'id': role_id, 'name': name, 'types': types})
+        movies = [{
+                'id': row.id,
+                'name': row.name,
+                'photoUrl': row.photoUrl,
+                'release': row.release.isoformat(),
+                'genres': row.genres,
+                'roles': roles.get(row.id, [])
+            } for row in rows]
+        return {'movies': movies, 'total': len(movie_ids), 'count': len(movies)}
+    @staticmethod
+    def read_costars(id, page=0, per_page=None):
+        """Get the actors sharing a movie with an actor, from the casting graph, the most shared
+        movies first
+        Keyword arguments:
+            id -- the integer id of the actor
+            page -- the integer page number, page<=0 returns the first MAX_UNPAGED_ITEMS actors
+            per_page -- the integer page size, ACTORS_PER_PAGE by default
+        Returns None when the actor does not exist or the page is out of range
+        """
+        shared = casting_graph_of_request().costars(id)
+        ranked = sorted(shared, key=lambda actor_id: (-shared[actor_id], actor_id))
+        per_page = page_size(per_page, ACTORS_PER_PAGE)
+        if page <= 0:
+            ranked = ranked[:MAX_UNPAGED_ITEMS]
+        elif (page-1)*per_page > len(shared):
+            return None
+        else:
+            ranked = ranked[(page-1)*per_page:page*per_page]
+        # the actor is read with the page, to know it exists
+        actors = {actor.id: actor for actor in Actors.query.filter(Actors.id.in_([id] + ranked)).all()}
+        if id not in actors:
+            return None
+        costars = [{'actor': actors[actor_id].format(), 'id': actor_id, 'movies': shared[actor_id]} for actor_id in ranked if actor_id in actors]
+        return {'costars': costars, 'total': len(shared), 'count': len(costars)}
+    @staticmethod
+    def read_path(source, target, max_depth=GRAPH_MAX_DEPTH):
+        """Get a shortest chain of actors and shared movies between two actors, from the casting graph
+        Keyword arguments:
+            source -- the integer id of the first actor
+            target -- the integer id of the last actor
+            max_depth -- the largest number of movies in the chain
+        Returns None when an actor does not exist, a None path when no chain is found
+        """
+        chain = casting_graph_of_request().path(source, target, max_depth)
+        actor_ids = {source, target} | set(chain[0::2] if chain else [])
+        actors = {actor.id: actor for actor in Actors.query.filter(Actors.id.in_(actor_ids)).all()}
+        if source not in actors or target not in actors:
+            return None
+        if chain is None:
+            return {'path': None, 'degrees': None}
+        movies = {movie.id: movie for movie in db.session.query(Movies.id, Movies.name, Movies.release).filter(Movies.id.in_(chain[1::2]))} if len(chain) > 1 else {}
+        path = []
+        for index, node in enumerate(chain):
+            if index % 2 == 0:
+                path.append({'actor': actors[node].format(), 'id': node} if node in actors else {'actor': None, 'id': node})
+            else:
+                movie = movies.get(node)
+                path.append({'movie': {'name': movie.name, 'release': movie.release.isoformat()} if movie is not None else None, 'id': node})
+        return {'path': path, 'degrees': len(chain) // 2}
     @staticmethod
-    def read(id):
+    def read(id, version=None):
         """Get the actor for an id
         Keyword arguments:
             id -- the integer id to search
+            version -- the current ETag of the actor, a cached actor of another version is reloaded
         """
-        item = Actors.query.get(id)
-        if item is None:
+        def load():
+            item = Actors.query.get(id)
+            if item is None:
+                return None
+            return item.format()
+        actor = read_cache.cached(('actor', id), [('actor', id)], load, version)
+        if actor is None:
             return None
-        return item.response()
+        return {'actor': actor, 'id': id}
     @staticmethod
-    def read_all(page=0):
+    def read_all(page=0, per_page=None, version=None):
         """Get all actors per page
         Keyword arguments:
             page -- the integer page number
+            per_page -- the integer page size, ACTORS_PER_PAGE by default
+            version -- the current ETag of the list, a cached page of another version is reloaded
         """
-        items = Actors.query.all()
-        total = len(items)
-
-        if page <= 0:
-            return { 'actors': [item.format() for item in items], 'total': total, 'count': total}
-        offset = (page-1)*MAX_ACTORS_PER_PAGE
-        if offset > total:
+        per_page = page_size(per_page, ACTORS_PER_PAGE)
+        def load():
+            result = paginate(db.session.query(Actors.id, Actors.version), [Actors.id], page, per_page)
+            if result is None:
+                return None
+            rows, total = result
+            return {'items': [[id, item_etag(Actors, id, row_version)] for id, row_version in rows], 'total': total}
+        result = read_cache.cached(('actors', page, per_page), ['actors'], load, version)
+        if result is None:
             return None
-        limit = min(offset + MAX_ACTORS_PER_PAGE,total)
-        return { 'actors': [item.format() for item in items][offset:limit], 'total': total, 'count':limit-offset}
+        items = cached_items(Actors, 'actor', result['items'], lambda ids: Actors.query.filter(Actors.id.in_(ids)).all())
+        return { 'actors': items, 'total': result['total'], 'count': len(items)}
+    @staticmethod
+    def export(after_id=None, until_id=None, since=None):
+        """Iterate over all the actors in id order, for the streaming export
+        Keyword arguments:
+            after_id -- only the actors with a greater id
+            until_id -- only the actors with a lower or equal id
+            since -- only the actors modified at or after this UTC datetime
+        """
+        for actor in export_rows(Actors.query, Actors, after_id, until_id, since):
+            yield actor.response()
+    @staticmethod
+    def sort_keys():
+        return {
+            'id': [Actors.id],
+            'name': [Actors.name, Actors.id],
+            'age': [Actors.age, Actors.id]
+        }
+    @staticmethod
+    def read_page(cursor, sort='id', per_page=None, *params):
+        """Get the actors after the cursor, keyset pagination, with the validators of the page
+        Keyword arguments:
+            cursor -- the String cursor of the previous response, empty for the first page
+            sort -- the String sort key: id, name or age
+            per_page -- the integer page size, ACTORS_PER_PAGE by default
+            params -- the request parameters selecting the page
+        Returns (responseStruct, validators)
+        """
+        columns = Actors.sort_keys().get(sort)
+        if columns is None:
+            raise ValueError('sort not valid')
+        items, next_cursor, prev_cursor = keyset_page(Actors.query, sort, columns, cursor, page_size(per_page, ACTORS_PER_PAGE))
+        validators = page_validators(Actors, items, next_cursor, prev_cursor, *params)
+        return { 'actors': [item.format() for item in items], 'count': len(items), 'next': next_cursor, 'prev': prev_cursor}, validators
 
 class Roles(db.Model):
     __tablename__ = 'Roles'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     types = db.Column(db.String(), nullable=False)
-    actors = db.relationship('Actors', secondary=roles_actors_items,lazy='subquery',backref=db.backref('roles', lazy=True))
+    actors = db.relationship('Actors', secondary=roles_actors_items,lazy='select',backref=db.backref('roles', lazy=True))
     movie_id = db.Column(db.Integer, db.ForeignKey('Movies.id'),nullable=False)
 
     def __init__(self,name, types, movie_id):
@@ -298,37 +1044,36 @@ class Roles(db.Model):
         self.types = types
         self.movie_id = movie_id
     def insert(self):
-        responseStruct = None
-        try:
-            db.session.add(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()
-        finally:
-            db.session.close()
-        return responseStruct
+        db.session.add(self)
+        cast = self.cast_changes()
+        # touch_movies autoflushes the role, which gets its id
+        touch_movies([self.movie_id])
+        invalidate_on_commit(*movie_tags([self.movie_id]))
+        graph_on_commit(*cast)
+        return self.response()
     def update(self):
-        responseStruct = None
-        try:
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct  
+        cast = self.cast_changes()
+        touch_movies([self.movie_id])
+        # the movie and its cast lists show the roles and the actors cast in them
+        invalidate_on_commit(*movie_tags([self.movie_id]))
+        graph_on_commit(*cast)
+        return self.response()
     def delete(self):
-        responseStruct = None
-        try:        
-            db.session.delete(self)
-            db.session.commit()
-            responseStruct = self.response()
-        except:
-            db.session.rollback()    
-        finally:
-            db.session.close()  
-        return responseStruct            
+        responseStruct = self.response()
+        touch_movies([self.movie_id])
+        actor_ids = [actor.id for actor in self.actors]
+        db.session.delete(self)
+        db.session.flush()
+        invalidate_on_commit(*movie_tags([self.movie_id]))
+        graph_on_commit(*[('cast', actor_id, self.movie_id, -1) for actor_id in actor_ids])
+        return responseStruct
+    def cast_changes(self):
+        """Get the casting changes of the actors added to or removed from the role, before the
+        flush resets their history
+        """
+        history = inspect(self).attrs.actors.history
+        return [('cast', actor.id, self.movie_id, 1) for actor in history.added or []] + \
+            [('cast', actor.id, self.movie_id, -1) for actor in history.deleted or []]
     def format(self):
         return {
             'name': self.name,
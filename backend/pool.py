@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, NullPool
+
+'''
+Connection pool
+
+Every worker process keeps at most DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections, a
+request waits DATABASE_POOL_TIMEOUT seconds for a free one before failing with 503. Behind
+PgBouncer in transaction pooling mode (DATABASE_PGBOUNCER), PgBouncer does the pooling: the
+process opens a connection to it per checkout, and the statement timeout is set per transaction
+as the session settings do not survive the transaction. The pools count the checkouts and the
+time spent getting a connection, reported by pool_stats().
+'''
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 5))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DATABASE_STATEMENT_TIMEOUT = int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', 0))
+DATABASE_PGBOUNCER = os.environ.get('DATABASE_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+
+class PoolTelemetry(object):
+    """Mixin of the pools counting the checkouts, the timeouts and the time spent getting a
+    connection, either waiting for a free one or opening a new one
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'pool': type(self).__name__,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'max_wait_seconds': round(self.max_wait_seconds, 6),
+                'mean_wait_seconds': round(self.wait_seconds / self.checkouts, 6) if self.checkouts else 0.0,
+            }
+
+class InstrumentedQueuePool(PoolTelemetry, QueuePool):
+    """QueuePool reporting its occupation with the telemetry"""
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+        })
+        return stats
+
+class PgBouncerPool(PoolTelemetry, NullPool):
+    """NullPool of the PgBouncer mode, every checkout opens a connection to PgBouncer"""
+    pass
+
+def engine_options(pgbouncer=DATABASE_PGBOUNCER, statement_timeout=DATABASE_STATEMENT_TIMEOUT):
+    """Get the create_engine options of the configuration, for SQLALCHEMY_ENGINE_OPTIONS
+    Keyword arguments:
+        pgbouncer -- True behind PgBouncer in transaction pooling mode
+        statement_timeout -- the integer statement timeout in milliseconds, 0 for none
+    """
+    if pgbouncer:
+        options = {'poolclass': PgBouncerPool, 'pool_pre_ping': False}
+        if statement_timeout > 0:
+            options['execution_options'] = {'local_statement_timeout': statement_timeout}
+        return options
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DATABASE_POOL_SIZE,
+        'max_overflow': DATABASE_MAX_OVERFLOW,
+        'pool_timeout': DATABASE_POOL_TIMEOUT,
+        'pool_recycle': DATABASE_POOL_RECYCLE,
+        'pool_pre_ping': DATABASE_POOL_PRE_PING,
+    }
+    if statement_timeout > 0:
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+@event.listens_for(Engine, 'begin')
+def set_local_statement_timeout(connection):
+    timeout = connection.get_execution_options().get('local_statement_timeout')
+    if timeout:
+        connection.execute(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+def pool_stats(engine):
+    """Get the statistics of the connection pool of an engine
+    Keyword arguments:
+        engine -- the SQLAlchemy engine
+    """
+    pool = engine.pool
+    if isinstance(pool, PoolTelemetry):
+        return pool.stats()
+    return {'pool': type(pool).__name__, 'status': pool.status()}
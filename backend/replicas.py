@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from flask import has_request_context, _request_ctx_stack
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+from cache import LocalBackend, READ_CACHE_PREFIX
+from pool import pool_stats
+
+'''
+Read replicas
+
+The endpoints guarded by a get: permission only read: their session reads from a read replica
+of DATABASE_REPLICAS, chosen round robin for the whole request, and every other request uses
+the primary of DATABASE_PATH. A client that wrote keeps reading from the primary for
+REPLICA_READ_YOUR_WRITES seconds after its write was committed, so it sees its own changes
+whatever the replication lag. The health of a replica (its connection and its replay lag) is
+checked every REPLICA_HEALTH_INTERVAL seconds on use; the reads go to the primary when no
+replica is healthy.
+'''
+DATABASE_REPLICAS = [url for url in os.environ.get('DATABASE_REPLICAS', '').split(',') if url.strip()]
+REPLICA_READ_YOUR_WRITES = float(os.environ.get('REPLICA_READ_YOUR_WRITES', 5))
+REPLICA_HEALTH_INTERVAL = float(os.environ.get('REPLICA_HEALTH_INTERVAL', 10))
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+REPLICA_WRITERS_SIZE = int(os.environ.get('REPLICA_WRITERS_SIZE', 4096))
+
+logger = logging.getLogger(__name__)
+
+# seconds the replica is behind the primary, 0 when it replayed everything it received,
+# and for a server that is not a standby
+REPLICA_LAG_QUERY = text('''SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END''')
+
+class Replica(object):
+    """A read replica, its engine is created on first use
+    Keyword arguments:
+        url -- the String connection url of the replica
+        options -- the create_engine options
+    """
+    def __init__(self, url, options):
+        self.url = url
+        self.options = options
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self._engine = None
+        self._lock = threading.Lock()
+    @property
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                self._engine = create_engine(self.url, **self.options)
+            return self._engine
+    def check(self):
+        """Check the connection and the replay lag of the replica, returns True when healthy"""
+        self.checked_at = time.monotonic()
+        try:
+            with self.engine.connect() as connection:
+                # the check is not a statement of the request that triggers it
+                lag = connection.execution_options(sql_instrumentation=False).execute(REPLICA_LAG_QUERY).scalar()
+        except SQLAlchemyError as e:
+            if self.healthy or self.lag is None:
+                logger.warning('read replica %s is not available: %s', self.name, e)
+            self.healthy, self.lag = False, None
+            return False
+        self.lag = float(lag) if lag is not None else None
+        self.healthy = self.lag is not None and self.lag <= REPLICA_MAX_LAG
+        if not self.healthy:
+            logger.warning('read replica %s is %s seconds behind', self.name, self.lag)
+        return self.healthy
+    @property
+    def name(self):
+        """The host, port and database of the url, without the credentials"""
+        url = urlparse(self.url)
+        return f'{url.hostname}:{url.port or 5432}{url.path}'
+    def stats(self):
+        stats = {'replica': self.name, 'healthy': self.healthy, 'lag_seconds': self.lag}
+        if self._engine is not None:
+            stats.update(pool_stats(self._engine))
+        return stats
+
+class ReplicaSet(object):
+    """The read replicas of an application, and the clients that wrote recently
+    Keyword arguments:
+        urls -- the list of String connection urls of the replicas
+        options -- the create_engine options of the primary, used for the replicas too
+        writers -- the CacheBackend remembering the writers, shared by the workers when it is
+                   the sqlite or memcached read cache backend, a LocalBackend of the process by default
+        window -- the seconds a writer keeps reading from the primary
+    """
+    def __init__(self, urls, options=None, writers=None, window=REPLICA_READ_YOUR_WRITES):
+        options = dict(options or {})
+        options['connect_args'] = dict(options.get('connect_args', {}), connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        self.replicas = [Replica(url, options) for url in urls]
+        self.writers = writers if writers is not None else LocalBackend(REPLICA_WRITERS_SIZE)
+        self.window = window
+        self.primary_reads = 0
+        self.replica_reads = 0
+        self._next = 0
+        self._lock = threading.Lock()
+    def choose(self):
+        """Get the engine of the next healthy replica, None when no replica is healthy"""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+            if replica.checked_at is None or time.monotonic() - replica.checked_at >= REPLICA_HEALTH_INTERVAL:
+                replica.check()
+            if replica.healthy:
+                return replica.engine
+        return None
+    @staticmethod
+    def writer_key(subject):
+        return f'{READ_CACHE_PREFIX}:writer:' + hashlib.sha1(subject.encode('utf-8')).hexdigest()
+    def record_write(self, subject):
+        """Keep the reads of a client on the primary for the window, after its write committed
+        Keyword arguments:
+            subject -- the String sub of the token of the client
+        """
+        if subject and self.window > 0:
+            self.writers.set_many({self.writer_key(subject): 1}, self.window)
+    def wrote_recently(self, subject):
+        if not subject or self.window <= 0:
+            return False
+        key = self.writer_key(subject)
+        return key in self.writers.get_many([key])
+    def route(self, subject):
+        """Get the replica engine of a read-only request, None for the primary
+        Keyword arguments:
+            subject -- the String sub of the token of the client
+        """
+        engine = None if self.wrote_recently(subject) else self.choose()
+        with self._lock:
+            if engine is None:
+                self.primary_reads += 1
+            else:
+                self.replica_reads += 1
+        return engine
+    def stats(self):
+        return {
+            'primary_reads': self.primary_reads,
+            'replica_reads': self.replica_reads,
+            'replicas': [replica.stats() for replica in self.replicas],
+        }
+    def dispose(self):
+        for replica in self.replicas:
+            if replica._engine is not None:
+                replica._engine.dispose()
+
+def request_subject():
+    """Get the sub of the token of the current request, None when it is not authenticated"""
+    ctx = _request_ctx_stack.top
+    payload = getattr(ctx, 'current_user', None) or {}
+    return payload.get('sub')
+
+def request_replica(app):
+    """Get the replica engine the current request reads from, chosen once per request, None for
+    the primary
+    Keyword arguments:
+        app -- the flask application
+    """
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'replica_engine'):
+        replicas = app.extensions.get('replicas')
+        ctx.replica_engine = None
+        if replicas is not None and getattr(ctx, 'read_only', False):
+            ctx.replica_engine = replicas.route(request_subject())
+    return ctx.replica_engine
+
+class RoutingSession(SignallingSession):
+    """Session reading from the replica of a read-only request, from the primary otherwise"""
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context():
+            engine = request_replica(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy service whose sessions route the read-only requests to the read replicas"""
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
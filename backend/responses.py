@@ -1,5 +1,15 @@
 import os
-from flask import jsonify
+import json
+from datetime import date, datetime
+from flask import request, has_request_context, stream_with_context, Response as FlaskResponse
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class AppError(Exception):
     def __init__(self, status_code, title, detail,type_error = None):
@@ -8,14 +18,111 @@ class AppError(Exception):
         self.title = title
         self.detail = detail
 
+'''
+Serializers
+
+The responses are encoded with orjson, or as MessagePack when the client prefers it in its Accept
+header. Both are pinned in requirements.txt; an environment missing them falls back to the stdlib
+encoder, and to JSON only. Dates are encoded in ISO 8601 by every serializer, tuples and sets as
+arrays.
+'''
+def to_serializable(value):
+    """Convert the values the encoders do not support natively"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+class JSONSerializer(object):
+    name = 'json'
+    mimetype = 'application/json'
+    def dumps(self, value):
+        """Encode a value as UTF-8 JSON bytes"""
+        if orjson is not None:
+            return orjson.dumps(value, default=to_serializable, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, default=to_serializable, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+class MessagePackSerializer(object):
+    name = 'msgpack'
+    mimetype = 'application/msgpack'
+    def dumps(self, value):
+        """Encode a value as MessagePack bytes"""
+        return msgpack.packb(value, default=to_serializable, use_bin_type=True)
+
+json_serializer = JSONSerializer()
+serializers = {json_serializer.mimetype: json_serializer}
+if msgpack is not None:
+    serializers[MessagePackSerializer.mimetype] = serializers['application/x-msgpack'] = MessagePackSerializer()
+
+def negotiate_serializer():
+    """Get the serializer of the media type the client prefers in the Accept header, JSON by default"""
+    if not has_request_context():
+        return json_serializer
+    mimetype = request.accept_mimetypes.best_match(list(serializers), default=json_serializer.mimetype)
+    return serializers[mimetype]
+
 class Response(object):
     @staticmethod
+    def serialized_response(value):
+        """Encode a value with the serializer negotiated with the client
+        Keyword arguments:
+            value -- the dict to send
+        """
+        serializer = negotiate_serializer()
+        response = FlaskResponse(serializer.dumps(value), mimetype=serializer.mimetype)
+        response.vary.add('Accept')
+        return response
+    @staticmethod
     def success_response(responseStruct):
         response = {
             'success': True,
             'data': responseStruct
             }
-        return jsonify(response)
+        return Response.serialized_response(response)
+    @staticmethod
+    def conditional_response(validators, build):
+        """Answer 304 Not Modified when the validators sent by the client match the resource,
+        otherwise build the responseStruct and send it with its validators
+        Keyword arguments:
+            validators -- the (etag, last_modified) of the resource, last_modified may be None
+            build -- the function returning the responseStruct
+        """
+        etag, last_modified = validators
+        serializer = negotiate_serializer()
+        if serializer is not json_serializer:
+            # every representation has its own entity tag
+            etag = f'{etag}-{serializer.name}'
+        if request.if_none_match:
+            # If-None-Match takes precedence over If-Modified-Since
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and last_modified is not None and \
+                last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+        if not_modified:
+            response = FlaskResponse(status=304)
+            response.vary.add('Accept')
+        else:
+            # the validators are read before the body: a change in between only costs the client a full response
+            response = Response.success_response(build())
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # authorized responses: browsers may keep them, but must revalidate before use
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    @staticmethod
+    def ndjson_response(items):
+        """Stream newline-delimited JSON, each item is encoded and sent as soon as it is produced
+        Keyword arguments:
+            items -- the iterable of dicts to send, one per line
+        """
+        def generate():
+            for item in items:
+                yield json_serializer.dumps(item) + b'\n'
+        return FlaskResponse(stream_with_context(generate()), mimetype='application/x-ndjson')
     @staticmethod
     def error_response(app_error):
         response = {
@@ -26,4 +133,4 @@ class Response(object):
             'detail': app_error.detail,
             'instance': "about:blank"
             }
-        return jsonify(response)
\ No newline at end of file
+        return Response.serialized_response(response)
\ No newline at end of file
@@ -0,0 +1,46 @@
+from sqlalchemy import func, or_, text
+from sqlalchemy.exc import SQLAlchemyError
+
+'''
+Search engine
+
+Relevance ranked search on the name columns. The tsvector column of the model is matched with
+the full-text GIN index, and when the pg_trgm extension is installed the name is also matched
+with the trigram GIN index (indexed ILIKE) and ranked by trigram similarity. Without pg_trgm the
+search falls back to the plain ILIKE substring match.
+'''
+TEXT_SEARCH_CONFIG = 'simple'
+
+class SearchEngine(object):
+    """Build the filter and the relevance of a search term on a model
+    Keyword arguments:
+        db -- the flask_sqlalchemy service
+    """
+    def __init__(self, db):
+        self.db = db
+        self._trigram = None
+    def has_trigram(self):
+        """Check once per process whether the pg_trgm extension is installed
+        """
+        if self._trigram is None:
+            try:
+                self._trigram = self.db.session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+            except SQLAlchemyError:
+                self.db.session.rollback()
+                self._trigram = False
+        return self._trigram
+    def match(self, name_column, tsv_column, term):
+        """Get the filter clause and the relevance expression for a search term
+        Keyword arguments:
+            name_column -- the String column searched
+            tsv_column -- the tsvector column computed from the name column
+            term -- the String term to search
+        Returns (clause, rank)
+        """
+        tsquery = func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)
+        substring = name_column.ilike(f'%{term}%')
+        clause = or_(substring, tsv_column.op('@@')(tsquery))
+        rank = func.ts_rank(tsv_column, tsquery)
+        if self.has_trigram():
+            rank = func.greatest(rank, func.similarity(name_column, term))
+        return clause, rank
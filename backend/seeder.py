@@ -0,0 +1,242 @@
+import math
+import random
+import time
+from array import array
+from datetime import datetime, timedelta
+from itertools import accumulate
+from models import db, read_cache, BUMP_LIST_GENERATIONS, LIST_TAGS
+from graph import casting_graph
+from importer import array_literal
+
+'''
+Synthetic dataset generator
+
+Generates a catalog of movies, actors, roles and castings shaped like production data, the same
+catalog for the same seed and sizes: the number of roles per movie follows a Pareto law (most
+movies have a few roles, some blockbusters hundreds), the actors are cast following a Zipf law
+of their popularity (a few actors play in thousands of roles), the words of the titles and the
+names are drawn from Zipfian vocabularies, so that search terms have realistic selectivities,
+and the genres from a skewed list.
+
+The rows are streamed with COPY straight into the tables, in one transaction: the secondary
+indexes and the foreign keys of the tables are dropped first and recreated once the tables are
+filled, which builds each index in a single pass and checks each foreign key with a single join.
+
+Replacing the rows reuses their ids: the new movies and actors continue the versions of the rows
+they replace, so that no ETag of a replaced row, held by a client or by a read cache, matches a
+new one. The generations of the lists are bumped in the same transaction, and the lists of the
+read cache and the casting graph of the process are invalidated.
+'''
+GENRES = ['Drama', 'Comedy', 'Action', 'Thriller', 'Romance', 'Horror', 'Documentary', 'Crime', 'Adventure',
+    'Animation', 'Science Fiction', 'Fantasy', 'Family', 'Mystery', 'War', 'Western', 'Musical', 'History']
+ROLE_TYPES = ['Lead Actor', 'Supporting Actor', 'Cameo', 'Voice', 'Extra']
+ROLE_TYPE_WEIGHTS = [10, 30, 5, 3, 52]
+GENDERS = ['Female', 'Male']
+
+TITLE_WORDS = 4000
+FIRST_NAMES = 1500
+LAST_NAMES = 8000
+WORD_EXPONENT = 1.1
+ACTOR_EXPONENT = 0.7
+# the roles per movie follow a Pareto law of this shape, capped at MAX_ROLES
+ROLES_SHAPE = 1.5
+MAX_ROLES = 1000
+COPY_BUFFER = 1 << 20
+
+TABLES = ['Movies', 'Actors', 'Roles', 'roles_in_movies', 'actors_for_roles']
+VERSIONED_TABLES = ['Movies', 'Actors']
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ven', 'tor', 'el', 'an', 'dri', 'sa', 'mon', 'ter', 'bel', 'or', 'is', 'na',
+    'gar', 'lin', 'ro', 'da', 'fen', 'wick', 'ly', 'ston', 'har', 'mar', 'ce', 'vi', 'ob', 'us']
+
+def vocabulary(rng, size):
+    """Generate a list of distinct capitalized words"""
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))).capitalize()
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def zipf_weights(size, exponent):
+    """Cumulative weights of ranks 1 to size following a Zipf law"""
+    return array('d', accumulate(1.0 / rank ** exponent for rank in range(1, size + 1)))
+
+def role_counts(seed, movies, mean_roles):
+    """Iterate over the (movie id, number of roles) of the movies, with mean_roles roles on average"""
+    rng = random.Random(f'{seed}:roles')
+    scale = mean_roles * (ROLES_SHAPE - 1) / ROLES_SHAPE
+    for movie_id in range(1, movies + 1):
+        yield movie_id, min(MAX_ROLES, max(1, int(round(scale * rng.paretovariate(ROLES_SHAPE)))))
+
+class Catalog(object):
+    """The generator of the rows of a catalog
+    Keyword arguments:
+        seed -- the integer seed, the same seed and sizes give the same rows
+        movies -- the number of movies
+        actors -- the number of actors
+        mean_roles -- the mean number of roles per movie, each role is cast with one actor
+    """
+    def __init__(self, seed, movies, actors, mean_roles):
+        self.seed = seed
+        self.movies = movies
+        self.actors = actors
+        self.mean_roles = mean_roles
+        rng = random.Random(f'{seed}:vocabulary')
+        self.words = vocabulary(rng, TITLE_WORDS)
+        self.first_names = vocabulary(rng, FIRST_NAMES)
+        self.last_names = vocabulary(rng, LAST_NAMES)
+        self.word_weights = zipf_weights(TITLE_WORDS, WORD_EXPONENT)
+        self.first_weights = zipf_weights(FIRST_NAMES, WORD_EXPONENT)
+        self.last_weights = zipf_weights(LAST_NAMES, WORD_EXPONENT)
+    def movie_rows(self):
+        rng = random.Random(f'{self.seed}:movies')
+        start = datetime(1920, 1, 1)
+        days = (datetime(2025, 1, 1) - start).days
+        genre_weights = zipf_weights(len(GENRES), 1.0)
+        for movie_id in range(1, self.movies + 1):
+            name = ' '.join(rng.choices(self.words, cum_weights=self.word_weights, k=rng.randint(1, 5)))
+            # more movies were released in the recent years
+            release = start + timedelta(days=int(days * math.sqrt(rng.random())))
+            genres = sorted(set(rng.choices(GENRES, cum_weights=genre_weights, k=rng.randint(1, 3))))
+            yield (movie_id, name, '', release.isoformat(), array_literal(genres))
+    def actor_rows(self):
+        rng = random.Random(f'{self.seed}:actors')
+        for actor_id in range(1, self.actors + 1):
+            name = rng.choices(self.first_names, cum_weights=self.first_weights)[0] + ' ' + rng.choices(self.last_names, cum_weights=self.last_weights)[0]
+            yield (actor_id, name, '', rng.choice(GENDERS), int(rng.triangular(8, 90, 32)))
+    def roles(self):
+        """Iterate over the (role id, movie id) of the roles"""
+        role_id = 0
+        for movie_id, count in role_counts(self.seed, self.movies, self.mean_roles):
+            for _ in range(count):
+                role_id += 1
+                yield role_id, movie_id
+    def role_rows(self):
+        rng = random.Random(f'{self.seed}:role-rows')
+        for role_id, movie_id in self.roles():
+            name = rng.choices(self.first_names, cum_weights=self.first_weights)[0]
+            yield (role_id, name, rng.choices(ROLE_TYPES, ROLE_TYPE_WEIGHTS)[0], movie_id)
+    def movie_role_rows(self):
+        for role_id, movie_id in self.roles():
+            yield (movie_id, role_id)
+    def casting_rows(self):
+        rng = random.Random(f'{self.seed}:castings')
+        weights = zipf_weights(self.actors, ACTOR_EXPONENT)
+        # the popularity rank of an actor is not its id: rank r is actor (r * step) mod actors
+        step = next(step for step in range(self.actors // 2 + 1, 2 * self.actors + 2) if math.gcd(step, self.actors) == 1)
+        population = range(self.actors)
+        for role_id, _ in self.roles():
+            rank = rng.choices(population, cum_weights=weights)[0]
+            yield (role_id, rank * step % self.actors + 1)
+    def rows(self, table):
+        return {
+            'Movies': (('id', 'name', 'photoUrl', 'release', 'genres'), self.movie_rows),
+            'Actors': (('id', 'name', 'photoUrl', 'gender', 'age'), self.actor_rows),
+            'Roles': (('id', 'name', 'types', 'movie_id'), self.role_rows),
+            'roles_in_movies': (('movie_id', 'role_id'), self.movie_role_rows),
+            'actors_for_roles': (('role_id', 'actor_id'), self.casting_rows),
+        }[table]
+
+class RowsFile(object):
+    """A file-like reader of rows in the COPY text format, for cursor.copy_expert"""
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+    def read(self, size=-1):
+        size = COPY_BUFFER if size is None or size < 0 else size
+        lines = []
+        length = len(self.buffer)
+        while length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = '\t'.join(str(value) for value in row) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = self.buffer + ''.join(lines)
+        self.buffer = data[size:]
+        return data[:size]
+
+def drop_constraints(cursor):
+    """Drop the foreign keys and the secondary indexes of the tables, returns the statements
+    recreating them
+    """
+    cursor.execute('''SELECT constraints.conrelid::regclass::text, constraints.conname, pg_get_constraintdef(constraints.oid)
+        FROM pg_constraint constraints JOIN pg_class tables ON tables.oid = constraints.conrelid
+        WHERE constraints.contype = 'f' AND tables.relname = ANY(%s) AND tables.relnamespace = current_schema()::regnamespace''', (TABLES,))
+    foreign_keys = cursor.fetchall()
+    cursor.execute('''SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = ANY(%s)
+        AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE contype IN ('p', 'u'))''', (TABLES,))
+    indexes = cursor.fetchall()
+    for table, name, _ in foreign_keys:
+        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX "{name}"')
+    return [definition for _, definition in indexes] + [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for table, name, definition in foreign_keys]
+
+def seed_catalog(movies, actors, mean_roles, seed=0, truncate=False, out=print):
+    """Fill the empty tables with a generated catalog
+    Keyword arguments:
+        movies -- the number of movies
+        actors -- the number of actors
+        mean_roles -- the mean number of roles per movie, each role is cast with one actor
+        seed -- the integer seed of the generator
+        truncate -- True to empty the tables first, the tables must be empty otherwise
+        out -- the function printing the progress
+    Returns the dict of the number of rows per table
+    """
+    if movies < 1 or actors < 1 or mean_roles < 1:
+        raise ValueError('movies, actors and roles must be positive')
+    catalog = Catalog(seed, movies, actors, mean_roles)
+    counts = {}
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        version = 1
+        if truncate:
+            cursor.execute(' UNION ALL '.join(f'SELECT max(version) FROM "{table}"' for table in VERSIONED_TABLES))
+            version = max((row[0] or 0 for row in cursor.fetchall()), default=0) + 1
+            cursor.execute('TRUNCATE ' + ', '.join(f'"{table}"' for table in TABLES) + ' RESTART IDENTITY')
+        else:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM "Movies") OR EXISTS (SELECT 1 FROM "Actors") OR EXISTS (SELECT 1 FROM "Roles")')
+            if cursor.fetchone()[0]:
+                raise ValueError('the tables are not empty, seed with truncate to replace their rows')
+        cursor.execute("SET LOCAL maintenance_work_mem = '512MB'")
+        recreate = drop_constraints(cursor)
+        started = time.monotonic()
+        for table in TABLES:
+            columns, rows = catalog.rows(table)
+            rows = rows()
+            if table in VERSIONED_TABLES:
+                columns, rows = columns + ('version',), (row + (version,) for row in rows)
+            source = RowsFile(rows)
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            cursor.copy_expert(f'COPY "{table}" ({column_list}) FROM STDIN', source, size=COPY_BUFFER)
+            counts[table] = source.count
+            out(f'{table}: {source.count} rows, {time.monotonic() - started:.1f}s')
+        for statement in recreate:
+            cursor.execute(statement)
+        out(f'indexes and foreign keys: {len(recreate)} rebuilt, {time.monotonic() - started:.1f}s')
+        for table in ('Movies', 'Actors', 'Roles'):
+            cursor.execute(f'''SELECT setval(pg_get_serial_sequence('"{table}"', 'id'), coalesce(max(id), 1), max(id) IS NOT NULL) FROM "{table}"''')
+        cursor.execute(BUMP_LIST_GENERATIONS, {'names': list(LIST_TAGS)})
+        connection.commit()
+        # ANALYZE outside of the transaction, so that the planner knows the new sizes
+        for table in TABLES:
+            cursor.execute(f'ANALYZE "{table}"')
+        connection.commit()
+        # the items are invalidated by their versions, the lists and castings here
+        read_cache.invalidate('movies', 'actors')
+        casting_graph.clear()
+        out(f'seeded in {time.monotonic() - started:.1f}s')
+        return counts
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()